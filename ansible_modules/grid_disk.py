@@ -1,66 +1,163 @@
 #!/usr/bin/python
 
-import os, platform, subprocess, pwd, grp, stat
+import os, platform, subprocess, sys, pwd, grp, stat, re
 from stat import S_IMODE
+from multiprocessing.pool import ThreadPool
+sys.path.append("/home/clallen/work/autobuild/ansible_modules")
+import tracing
 
-GAWK_CODE = 'BEGIN { RS=":" } { if (NR==2) { sect_per_cyl=$11\ntotal_cyl=$17 } } END { first_sect=sect_per_cyl\nsect_count=(sect_per_cyl * total_cyl - first_sect)\nprint "0 0 00 "first_sect" "sect_count }'
+PRTVTOC = "/usr/sbin/prtvtoc"
+FORMAT = "/usr/sbin/format"
+FMTHARD = "/usr/sbin/fmthard"
+RDSK_DIR = "/dev/rdsk"
 
-def main():
-    module = AnsibleModule(argument_spec = dict(), supports_check_mode = True)
+def parse_vtoc(output):
+    """ Parse C{prtvtoc} output into its dimensions and partitions:
 
-    changed = False
-    msg = []
+    { "dimensions": { "bytes/sector": 512, "sectors/cylinder": 640,
+                      "accessible cylinders": 32764, ... },
+      "partitions": [ { "slice": 0, "tag": "0", "flags": "00", "first": 640,
+                        "count": 20968960, "last": 20969599 }, ... ] }
+    """
+    dimensions = dict()
+    partitions = []
+    for line in output.splitlines():
+        if line.startswith("*"):
+            match = re.match(r"^\*\s+(\d+)\s+([a-z/ ]+)$", line.rstrip())
+            if match is not None:
+                dimensions[match.group(2)] = int(match.group(1))
+            continue
+        fields = line.split()
+        if len(fields) < 6:
+            continue
+        partitions.append({ "slice": int(fields[0]), "tag": fields[1],
+                            "flags": fields[2], "first": int(fields[3]),
+                            "count": int(fields[4]), "last": int(fields[5]) })
+    return { "dimensions": dimensions, "partitions": partitions }
 
-    if platform.system() != "SunOS":
-        module.fail_json(msg = "This module requires Solaris")
+def whole_disk_slice(vtoc):
+    """ Return the C{fmthard -s} datafile for a single slice 0 covering every
+    accessible cylinder but the first. """
+    try:
+        sect_per_cyl = vtoc["dimensions"]["sectors/cylinder"]
+        total_cyl = vtoc["dimensions"]["accessible cylinders"]
+    except KeyError:
+        raise ValueError("label has no cylinder geometry")
+    first_sect = sect_per_cyl
+    sect_count = sect_per_cyl*total_cyl-first_sect
+    return "0 0 00 "+str(first_sect)+" "+str(sect_count)+"\n"
 
-    if module.check_mode:
-        self.msg.append('RUNNING IN CHECK MODE - NO CHANGES WILL BE MADE')
+def _prtvtoc(device):
+    proc = subprocess.Popen([PRTVTOC, device], stdout = subprocess.PIPE,
+                            stderr = subprocess.PIPE, close_fds = True)
+    output = proc.communicate()[0]
+    return proc.returncode, output
 
+def prepare_disk(device, grid_uid, grid_gid, check_mode):
+    """ Label a disk, give it a whole disk partition table and set the owner
+    and permissions of its data slice.  Returns a tuple of (changed, msg list,
+    error), where error is None unless a command failed. """
+    changed = False
+    msg = []
     devnull_fd = open(os.devnull, 'w')
-    for index in range(10, 90):
-        device = "/dev/rdsk/c1d"+str(index)+"s2"
-        if not os.path.exists(device):
-            continue
+    try:
         msg.append("Checking disk "+device)
         # label disk
-        code = subprocess.call(["/usr/sbin/prtvtoc", device], stdout = devnull_fd)
+        code, output = _prtvtoc(device)
         if code != 0:
             msg.append("Labelling disk")
-            if not module.check_mode:
-                subprocess.call(["/usr/sbin/format", "-L", "vtoc", "-d", os.path.basename(device)[:-2]], stdout = devnull_fd)
+            if not check_mode:
+                subprocess.call([FORMAT, "-L", "vtoc", "-d", os.path.basename(device)[:-2]], stdout = devnull_fd)
                 changed = True
+                code, output = _prtvtoc(device)
         # create whole disk partition table
-        linecount = subprocess.check_output("/usr/sbin/prtvtoc "+device+" | /usr/bin/grep -v ^* | wc -l", shell = True)
-        linecount.strip()
-        if int(linecount) != 2:
+        vtoc = parse_vtoc(output)
+        if code != 0 or len(vtoc["partitions"]) != 2:
             msg.append("Creating whole disk partition table")
-            if not module.check_mode:
-                subprocess.call("/usr/sbin/prtvtoc "+device+" | gawk '"+GAWK_CODE+"' | /usr/sbin/fmthard -s - "+device,
-                                shell = True, stdout = devnull_fd)
+            if not check_mode:
+                proc = subprocess.Popen([FMTHARD, "-s", "-", device], stdin = subprocess.PIPE,
+                                        stdout = devnull_fd, stderr = subprocess.PIPE,
+                                        close_fds = True)
+                stderr = proc.communicate(whole_disk_slice(vtoc))[1]
+                if proc.returncode != 0:
+                    return changed, msg, device+": fmthard failed: "+stderr.strip()
                 changed = True
         # set owner/perms
         pdevice = device.replace("s2", "s0")
-        grid_uid = pwd.getpwnam("grid").pw_uid
-        grid_gid = grp.getgrnam("dba").gr_gid
         stat = os.stat(pdevice)
         if stat.st_uid != grid_uid:
             msg.append("Setting owner to grid")
-            if not module.check_mode:
+            if not check_mode:
                 os.chown(pdevice, grid_uid, -1)
                 changed = True
         if stat.st_gid != grid_gid:
             msg.append("Setting group to dba")
-            if not module.check_mode:
+            if not check_mode:
                 os.chown(pdevice, -1, grid_gid)
                 changed = True
         filemode = oct(S_IMODE(os.stat(pdevice).st_mode))
         if filemode != "0660":
             msg.append("Setting permissions to 660")
-            if not module.check_mode:
+            if not check_mode:
                 os.chmod(pdevice, 0660)
                 changed = True
-    devnull_fd.close()
+    except (OSError, ValueError) as e:
+        return changed, msg, device+": "+str(e)
+    finally:
+        devnull_fd.close()
+    return changed, msg, None
+
+def main():
+    module = AnsibleModule(
+        argument_spec = dict(
+            concurrency = dict(default = 8, type = "int"),
+            trace_file = dict(default = None, type = "str")
+        ),
+        supports_check_mode = True
+    )
+    tracing.install(module, "grid_disk")
+
+    changed = False
+    msg = []
+
+    if platform.system() != "SunOS":
+        module.fail_json(msg = "This module requires Solaris")
+
+    if module.params["concurrency"] < 1:
+        module.fail_json(msg = "concurrency must be at least 1")
+
+    if module.check_mode:
+        msg.append('RUNNING IN CHECK MODE - NO CHANGES WILL BE MADE')
+
+    grid_uid = pwd.getpwnam("grid").pw_uid
+    grid_gid = grp.getgrnam("dba").gr_gid
+
+    devices = []
+    for index in range(10, 90):
+        device = os.path.join(RDSK_DIR, "c1d"+str(index)+"s2")
+        if os.path.exists(device):
+            devices.append(device)
+
+    # disks are independent, so inspect and label them in a worker pool; map()
+    # keeps the results in disk order
+    pool = ThreadPool(min(module.params["concurrency"], max(len(devices), 1)))
+    try:
+        results = pool.map(lambda device: prepare_disk(device, grid_uid, grid_gid,
+                                                       module.check_mode), devices)
+    finally:
+        pool.close()
+        pool.join()
+
+    errors = []
+    for disk_changed, disk_msg, error in results:
+        msg.extend(disk_msg)
+        if disk_changed:
+            changed = True
+        if error is not None:
+            errors.append(error)
+
+    if len(errors) != 0:
+        module.fail_json(changed = changed, msg = " | ".join(msg+errors))
 
     module.exit_json(changed = changed, msg = " | ".join(msg))
 
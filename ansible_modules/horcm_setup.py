@@ -1,8 +1,9 @@
 #!/usr/bin/python
 
-import platform, sys
+import os, platform, sys, tempfile, hashlib
 sys.path.append("/home/clallen/work/autobuild/ansible_modules")
 from ldevblock import LDEVBlock
+import tracing
 
 MON_COLUMNS_FORMAT = "{:15}{:10}{:15}{}"
 LDEV_COLUMNS_FORMAT = "{:30}{:30}{:10}{:18}{}"
@@ -20,15 +21,122 @@ HORCM_CONF_TEMPLATE = ("HORCM_MON\n"+
                       INST_COLUMNS_FORMAT+"\n"
                       "{}\n")
 SI_HOST = "boxmgr"
+SVCCFG = "/usr/sbin/svccfg"
+SVCADM = "/usr/sbin/svcadm"
+SVCS = "/usr/bin/svcs"
+HORCM_CONF_DIR = "/etc"
+SERVICE = "site/horcm"
+
+def instance_state(module, instance):
+    """ Read a service instance's property groups and properties with a single
+    C{svccfg listprop}.  Returns None if the instance does not exist, otherwise
+    a tuple of (set of property group names, dictionary of property values). """
+    rc, stdout, stderr = module.run_command([SVCCFG, "-s", SERVICE+":"+instance, "listprop"])
+    if rc != 0:
+        return None
+    pgs = set()
+    props = dict()
+    for line in stdout.splitlines():
+        fields = line.split(None, 2)
+        if not fields:
+            continue
+        if "/" in fields[0]:
+            props[fields[0]] = fields[2] if len(fields) > 2 else ""
+        else:
+            pgs.add(fields[0])
+    return pgs, props
+
+def section_hashes(text):
+    """ Hash each HORCM_* section of a config, ignoring comments, blank lines
+    and column alignment, so only a change in content gives a new hash. """
+    sections = dict()
+    current = None
+    for line in text.splitlines():
+        line = line.strip()
+        if line == "" or line.startswith("#"):
+            continue
+        if line.startswith("HORCM_"):
+            current = line
+            sections[current] = hashlib.sha1()
+        elif current is not None:
+            sections[current].update(" ".join(line.split())+"\n")
+    return dict((name, digest.hexdigest()) for name, digest in sections.items())
+
+def split_sections(text):
+    """ Split a config into a list of (section name, text) tuples, in file
+    order.  Each section runs from its HORCM_* line up to the next one; any
+    lines before the first section are returned under the name None. """
+    sections = [ (None, []) ]
+    for line in text.splitlines(True):
+        if line.strip().startswith("HORCM_"):
+            sections.append((line.strip(), []))
+        sections[-1][1].append(line)
+    return [ (name, "".join(lines)) for name, lines in sections
+             if name is not None or len(lines) != 0 ]
+
+def replace_sections(text, new_text, names):
+    """ Return C{text} with the sections in C{names} replaced by those of
+    C{new_text}, leaving every other line as it is.  A section missing from
+    C{text} is appended. """
+    new_sections = dict(split_sections(new_text))
+    result = []
+    replaced = set()
+    for name, section in split_sections(text):
+        if name in names and name not in replaced:
+            section = new_sections[name]
+            replaced.add(name)
+        result.append(section)
+    for name in names:
+        if name not in replaced:
+            if len(result) != 0 and not result[-1].endswith("\n\n"):
+                result.append("\n" if result[-1].endswith("\n") else "\n\n")
+            result.append(new_sections[name])
+    return "".join(result)
+
+def write_atomic(module, path, content):
+    """ Replace C{path} with C{content} via a temporary file and rename, keeping
+    the mode of any existing file. """
+    directory = os.path.dirname(path)
+    fd, tmpname = tempfile.mkstemp(dir = directory, prefix = "."+os.path.basename(path)+".")
+    try:
+        fh = os.fdopen(fd, "w")
+        fh.write(content)
+        fh.close()
+        if os.path.exists(path):
+            os.chmod(tmpname, os.stat(path).st_mode & 07777)
+        else:
+            os.chmod(tmpname, 0644)
+        os.rename(tmpname, path)
+    except (IOError, OSError) as e:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        module.fail_json(msg = "Error writing "+path+": "+str(e))
+
+def apply_script(module, commands):
+    """ Run C{commands} as one C{svccfg -f} script. """
+    fd, script = tempfile.mkstemp(prefix = "horcm_setup.", suffix = ".svccfg")
+    try:
+        fh = os.fdopen(fd, "w")
+        fh.write("\n".join(commands)+"\n")
+        fh.close()
+        module.run_command([SVCCFG, "-f", script], check_rc = True)
+    finally:
+        os.remove(script)
 
 def main():
     module = AnsibleModule(
         argument_spec = dict(
             horcminst = dict(required = True, type = "int"),
-            disk_groups = dict(required = True, type = "list")
+            disk_groups = dict(required = True, type = "list"),
+            backup = dict(default = True, type = "bool"),
+            # empty disables the device inventory cache
+            inventory_cache = dict(default = LDEVBlock.INVENTORY_CACHE, type = "str"),
+            trace_file = dict(default = None, type = "str")
         ),
         supports_check_mode = True
     )
+    tracing.install(module, "horcm_setup")
+    LDEVBlock.INVENTORY_CACHE = module.params["inventory_cache"] or None
 
     changed = False
     msg = []
@@ -37,27 +145,25 @@ def main():
     horcminst_str = "horcm"+str(horcminst)
     disk_groups = module.params["disk_groups"]
 
-    # add service instance
-    stdout = module.run_command("/usr/sbin/svccfg -s site/horcm:"+horcminst_str+" list")[1]
-    if stdout.strip() != ":properties":
+    # read the instance once, then apply everything missing in one script
+    state = instance_state(module, horcminst_str)
+    commands = []
+    if state is None:
         msg.append("Adding "+horcminst_str+" service instance")
-        if not module.check_mode:
-            module.run_command("/usr/sbin/svccfg -s site/horcm add "+horcminst_str, check_rc = True)
-            changed = True
-    # add property groups
-    stdout = module.run_command("/usr/sbin/svccfg -s site/horcm:"+horcminst_str+" listpg")[1]
-    if stdout.strip() == "":
+        commands.extend(["select "+SERVICE, "add "+horcminst_str])
+        pgs, props = set(), dict()
+    else:
+        pgs, props = state
+    commands.append("select "+SERVICE+":"+horcminst_str)
+    if "general" not in pgs:
         msg.append("Adding "+horcminst_str+" property groups")
-        if not module.check_mode:
-            module.run_command("/usr/sbin/svccfg -s site/horcm:"+horcminst_str+" addpg general framework", check_rc = True)
-            changed = True
-    # add general/enabled property value
-    stdout = module.run_command("/usr/sbin/svccfg -s site/horcm:"+horcminst_str+" listprop general/enabled")[1]
-    if stdout.strip() == "":
+        commands.append("addpg general framework")
+    if "general/enabled" not in props:
         msg.append("Adding "+horcminst_str+" general/enabled property value")
-        if not module.check_mode:
-            module.run_command("/usr/sbin/svccfg -s site/horcm:"+horcminst_str+" addpropvalue general/enabled boolean: false", check_rc = True)
-            changed = True
+        commands.append("addpropvalue general/enabled boolean: false")
+    if len(commands) > 1 and not module.check_mode:
+        apply_script(module, commands)
+        changed = True
 
     # populate template
     msg.append("Building HORCM config")
@@ -78,20 +184,45 @@ def main():
                                                   "#dev_group", "ip_address", "service",
                                                   "\n".join(inst_lines))
 
-    # write out the file
-    horcm_conf_file = "/etc/"+horcminst_str+".conf"
+    # only the LDEV/INST sections are managed; the rest of an existing
+    # config may have been tuned by hand, so it is kept as it is
+    horcm_conf_file = os.path.join(HORCM_CONF_DIR, horcminst_str+".conf")
     if os.path.isfile(horcm_conf_file):
-        msg.append("HORCM config file "+horcm_conf_file+" exists, not overwriting")
+        try:
+            fh = open(horcm_conf_file)
+            current_text = fh.read()
+            fh.close()
+        except IOError as e:
+            module.fail_json(msg = "Error reading "+horcm_conf_file+": "+e.strerror)
+        current = section_hashes(current_text)
+        wanted = section_hashes(horcm_conf_lines)
+        stale = [ section for section in ("HORCM_LDEV", "HORCM_INST")
+                  if current.get(section) != wanted[section] ]
+        if len(stale) != 0:
+            horcm_conf_lines = replace_sections(current_text, horcm_conf_lines, stale)
     else:
-        msg.append("Writing HORCM config to "+horcm_conf_file)
+        stale = None
+    if stale == []:
+        msg.append("HORCM config file "+horcm_conf_file+" is up to date")
+    else:
+        if stale is None:
+            msg.append("Writing HORCM config to "+horcm_conf_file)
+        else:
+            msg.append("Updating "+", ".join(stale)+" in HORCM config "+horcm_conf_file)
         if not module.check_mode:
-            try:
-                fh = open(horcm_conf_file, "w+")
-            except IOError as e:
-                module.fail_json(msg = "Error opening "+horcm_conf_file+": "+e.strerror)
-            fh.write(horcm_conf_lines)
-            fh.close()
+            if stale is not None and module.params["backup"]:
+                msg.append("Backed up old config to "+module.backup_local(horcm_conf_file))
+            write_atomic(module, horcm_conf_file, horcm_conf_lines)
             changed = True
+        # horcmd only reads its config at startup, so a running instance has to
+        # be restarted to see new groups; a stopped one picks it up when enabled
+        if stale is not None:
+            fmri = SERVICE+":"+horcminst_str
+            svc_state = module.run_command([SVCS, "-Ho", "state", fmri])[1].strip()
+            if svc_state == "online":
+                msg.append("Restarting "+fmri)
+                if not module.check_mode:
+                    module.run_command([SVCADM, "restart", fmri], check_rc = True)
 
     module.exit_json(changed = changed, msg = msg)
 
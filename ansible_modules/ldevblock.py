@@ -1,6 +1,8 @@
 #!/usr/bin/python
 
-import re, platform, subprocess
+import os, re, platform, shlex, subprocess, sys, time, threading
+sys.path.append("/home/clallen/work/autobuild/ansible_modules")
+import tracing, root_cache
 
 DOCUMENTATION = """
 ---
@@ -36,6 +38,42 @@ options:
             - ports: C{list} of ports to share through (e.g. CL1-B, CL2-B, CL7-F, CL8-F).
             - pool: Storage pool in which the block will be created.
             - chassis: C{list} of chassis to share to.
+    query_scope:
+        required: false
+        type: C{str}
+        description:
+            - How much of the array to read when checking existing LDEVs.
+            - C(block), one ranged query per block.
+            - C(cu), one query per CU, shared by all blocks in that CU.
+        choices: ['block', 'cu']
+        default: block
+    lock_window:
+        required: false
+        type: C{int}
+        description:
+            - All blocks are planned first and then changed under as few
+              meta_resource locks as possible.  This is the longest time, in
+              seconds, one lock may be held before it is released and taken
+              again.  Must be greater than 0 and less than the 60 second lock
+              lease.
+        default: 50
+    async_create:
+        required: false
+        type: C{bool}
+        description:
+            - Submit all of a block's LDEV creations back to back and check
+              their command status once per block, instead of waiting for each
+              LDEV to finish before creating the next.
+        default: false
+    trace_file:
+        required: false
+        type: C{str}
+        description:
+            - File on the target to which every command the module runs is
+              appended as a JSON line (command, duration, exit status and
+              byte counts) as soon as it finishes.  The same records are
+              always returned in the C{timings} result.
+        default: null
 """
 
 
@@ -45,6 +83,12 @@ class LDEVBlock:
     SAN_DATA = { 5: { "horcm_serial": "66673", "hex_serial": "10471" },
                  6: { "horcm_serial": "93133", "hex_serial": "16BCD" },
                  7: { "horcm_serial": "350112", "hex_serial": "C3C0" } }
+    # optional file that remembers each frame's command device across runs
+    CMD_DEVICE_CACHE = None
+    # device inventory kept between runs until /dev/rdsk changes; None disables
+    INVENTORY_CACHE = os.path.join(root_cache.CACHE_DIR, "hds_inventory.json")
+    _inventory = None
+    _cu_cache = {}
 
     def __init__(self, module, name, begin, end, size, ports, pool, chassis):
         self.module = module
@@ -56,10 +100,9 @@ class LDEVBlock:
         self.size = size
         self.begin = begin
         self.end = end
-        self.lock_cmd = "lock resource -resource_name meta_resource -time 60 -I"+self.horcm
-        self.unlock_cmd = "unlock resource -resource_name meta_resource -I"+self.horcm
 
         self.ldevs = []
+        self.ldev_info = None
         self.msg = []
         self.changed = False
 
@@ -78,20 +121,30 @@ class LDEVBlock:
         if self.module.check_mode:
             self.msg.append('RUNNING IN CHECK MODE - NO CHANGES WILL BE MADE')
 
-    def create(self):
+    def plan_create(self, plan):
+        """ Add the operations needed to create, rename and tier this block's
+        LDEVs to C{plan}.  With C{async_create}, all of the block's C{add ldev}
+        commands are submitted back to back and their command_status is
+        checked once for the whole batch. """
         name_idx = 1
-        cmd_list = []
-        cmd_list.append(self.lock_cmd)
+        batch = []
+        modify_ops = []
         for ldev_id in self.ldevs:
             # create
             if self._ldev_exists(ldev_id):
                 self.msg.append("LDEV "+ldev_id+" already exists, skipping")
                 name_idx += 1
                 continue
-            cmd_list.append("reset command_status -I"+self.horcm)
-            cmd_list.append("add ldev -pool "+str(self.pool)+" -ldev_id "+ldev_id+
-                            " -capacity "+self.size+"g -I"+self.horcm)
-            cmd_list.append("get command_status -I"+self.horcm)
+            add_cmd = ("add ldev -pool "+str(self.pool)+" -ldev_id "+ldev_id+
+                       " -capacity "+self.size+"g -I"+self.horcm)
+            cmd_list = []
+            if self.module.params["async_create"]:
+                batch.append(ldev_id)
+                batch.append(add_cmd)
+            else:
+                cmd_list.append("reset command_status -I"+self.horcm)
+                cmd_list.append(add_cmd)
+                cmd_list.append("get command_status -I"+self.horcm)
             # rename
             if name_idx > 9:
                 display_name_idx = str(name_idx)
@@ -104,29 +157,76 @@ class LDEVBlock:
             if self.pool in self.TIERED:
                 cmd_list.append("modify ldev -ldev_id "+ldev_id+" -status enable_reallocation 5 -I"+
                                 self.horcm)
-        cmd_list.append(self.unlock_cmd)
-        # only run commands if there are more than just lock and unlock
-        if len(cmd_list) > 2:
-            self._run_cmd_list(cmd_list)
-            self.changed = True
-
-    def share(self):
-        cmd_list = []
-        cmd_list.append(self.lock_cmd)
+            modify_ops.append(cmd_list)
+        if len(batch) != 0:
+            ldev_ids = batch[0::2]
+            cmd_list = [ "reset command_status -I"+self.horcm ]
+            cmd_list.extend(batch[1::2])
+            cmd_list.append("get command_status -I"+self.horcm)
+            plan.add(cmd_list, check = lambda results: self._check_batch(ldev_ids, results))
+        for cmd_list in modify_ops:
+            plan.add(cmd_list)
+
+    def _check_batch(self, ldev_ids, results):
+        """ Check the results of an asynchronous C{add ldev} batch, returning
+        an error naming the LDEVs that were not created, or None. """
+        failed = []
+        status_rc = 0
+        status_output = ""
+        for cmd, rc, output in results:
+            if cmd.startswith("add ldev") and rc != 0:
+                failed.append(cmd.split()[5])
+            elif cmd.startswith("get command_status"):
+                status_rc = rc
+                status_output = output
+        if status_rc != 0 or self._command_errors(status_output) != 0:
+            # the status only counts errors, so find out which LDEVs are missing;
+            # the plan holds the lock here, so a failed query is returned to it
+            # rather than failing the module
+            query = ("get ldev -ldev_id "+self.ldevs[0]+" -cnt "+str(len(self.ldevs))+
+                     " -I"+self.horcm)
+            rc, output = self.run_raidcom(self.module, query)
+            if rc != 0:
+                return ("LDEV creation failed ("+status_output+") and "+self.RAIDCOM+
+                        " "+query+" failed (rc "+str(rc)+"): "+output)
+            ldev_info = self._parse_ldevs(output)
+            for ldev_id in ldev_ids:
+                if ldev_id not in failed and not ldev_info.get(ldev_id, {}).get("defined"):
+                    failed.append(ldev_id)
+        if len(failed) != 0:
+            return ("LDEV creation failed for "+", ".join(failed)+": "+
+                    status_output)
+        return None
+
+    @staticmethod
+    def _command_errors(output):
+        """ Return the total ERR_CNT from C{raidcom get command_status}
+        output. """
+        errors = 0
+        column = None
+        for line in output.splitlines():
+            fields = line.split()
+            if "ERR_CNT" in fields:
+                column = fields.index("ERR_CNT")
+            elif column is not None and len(fields) > column and fields[column].isdigit():
+                errors += int(fields[column])
+        return errors
+
+    def plan_share(self, plan):
+        """ Add the LUN mappings needed to share this block's LDEVs to
+        C{plan}. """
         for ldev_id in self.ldevs:
             if len(self._get_shared_hosts(ldev_id)) != 0:
                 self.msg.append("LDEV "+ldev_id+" is already shared, skipping")
                 continue
+            cmd_list = []
             for port in self.ports:
                 for chassis in self.chassis:
                     cmd_list.append("add lun -port "+port+" "+chassis+"-pri -ldev_id "+
                                     ldev_id+" -I"+self.horcm)
                     cmd_list.append("add lun -port "+port+" "+chassis+"-sec -ldev_id "+
                                     ldev_id+" -I"+self.horcm)
-        cmd_list.append(self.unlock_cmd)
-        if len(cmd_list) > 2:
-            self._run_cmd_list(cmd_list)
-            self.changed = True
+            plan.add(cmd_list)
 
     @staticmethod
     def get_serial(horcminst):
@@ -138,14 +238,12 @@ class LDEVBlock:
     def get_cmd_device(horcminst):
         """ Return the command device for the given HORCM instance. """
         hex_serial = LDEVBlock.SAN_DATA[horcminst]["hex_serial"]
-        try:
-            output = subprocess.check_output("/usr/bin/ls /dev/rdsk/* | "+
-                                            "/HORCM/usr/bin/inqraid -sort -CM -CLI | "+
-                                            "/usr/bin/grep "+hex_serial, shell = True)
-        except subprocess.CalledProcessError as e:
-            print "Unable to get command device: "+str(e)
+        device = LDEVBlock.inventory(scan = False).get_cmd_device(hex_serial,
+                                                                  LDEVBlock.CMD_DEVICE_CACHE)
+        if device is None:
+            print "Unable to get command device for serial "+hex_serial
             exit(1)
-        return output.strip().split("/")[3]
+        return device
 
     @staticmethod
     def hds_scan(blockname, return_type):
@@ -158,75 +256,411 @@ class LDEVBlock:
         Return type "devices": { "ldevname1": "c0t60060E80166BCD0000016BCD00006DE0d0s2" }
         Return type "ldev": { "ldevname1": "15:6C" }
         """
-        try:
-            lines = subprocess.check_output("/usr/bin/ls /dev/rdsk/* | "+
-                                            "/HORCM/usr/bin/inqraid -fnx -CLI | "+
-                                            "/usr/bin/grep "+blockname, shell = True)
-        except subprocess.CalledProcessError as e:
-            print "Unable to scan for backend devices: "+str(e)
-            exit(1)
         result = dict()
-        if return_type == "device":
-            for line in lines.splitlines():
-                columns = line.split()
-                device = columns[0].strip()
-                name = columns[8].strip()
-                result[name] = device
-        elif return_type == "ldev":
-            for line in lines.splitlines():
-                columns = line.split()
-                tmp = columns[3].strip()
-                ldev = tmp[:2]+":"+tmp[2:]
-                name = columns[8].strip()
-                result[name] = ldev
+        for name, record in LDEVBlock.inventory().by_name.iteritems():
+            if blockname not in name:
+                continue
+            if return_type == "device":
+                result[name] = record["device"]
+            elif return_type == "ldev":
+                result[name] = record["ldev"]
         return result
 
-    def _ldev_exists(self, ldev):
-        output = self._run_cmd("get ldev -ldev_id "+ldev+" -I"+self.horcm)
-        if re.search(r"NOT DEFINED", output) is None:
-            return True
-        else:
-            return False
+    @staticmethod
+    def hds_find(names, return_type):
+        """ Like L{hds_scan}, but for a list of exact LDEV names.  Names the
+        host cannot see are left out of the result. """
+        result = dict()
+        by_name = LDEVBlock.inventory().by_name
+        for name in names:
+            if name not in by_name:
+                continue
+            record = by_name[name]
+            if return_type == "device":
+                result[name] = record["device"]
+            elif return_type == "ldev":
+                result[name] = record["ldev"]
+        return result
+
+    @staticmethod
+    def inventory(scan = True):
+        """ Return the device inventory shared by every lookup in this process.
+        It starts from the index saved in C{INVENTORY_CACHE} if that is still
+        current; otherwise the host is scanned on first use unless C{scan} is
+        False. """
+        if LDEVBlock._inventory is None:
+            LDEVBlock._inventory = HDSInventory()
+            if LDEVBlock.INVENTORY_CACHE is not None:
+                LDEVBlock._inventory.load(LDEVBlock.INVENTORY_CACHE)
+        if scan and not LDEVBlock._inventory.scanned:
+            LDEVBlock._inventory.scan(LDEVBlock.INVENTORY_CACHE)
+        return LDEVBlock._inventory
+
+    def _ldev_exists(self, ldev_id):
+        return self._query_ldevs()[ldev_id]["defined"]
 
     def _get_shared_hosts(self, ldev_id):
-        hosts = []
-        output = self._run_cmd("get ldev -ldev_id "+ldev_id+" -I"+self.horcm)
-        for line in output.splitlines():
-            if re.match(r"^PORTs", line):
-                portline = line.split(":")
-                portline.pop(0)
-                if len(portline) > 1:
-                    for glob in portline:
-                        port = glob.split()[0]
-                        host = glob.split()[2]
-                        if not host in hosts:
-                            hosts.append({ "port": port, "host": host })
-                break
-        return hosts
+        return self._query_ldevs()[ldev_id]["ports"]
 
-    def _run_cmd_list(self, cmd_list):
-        self.msg.append("raidcom commands: ")
-        for cmd in cmd_list:
-            if self.module.check_mode:
-                self.msg.append(self.RAIDCOM+" "+cmd)
+    def _query_ldevs(self):
+        """ Return a snapshot of every LDEV in the block, taken with a single
+        ranged raidcom query covering the block or, with C{query_scope=cu}, the
+        whole CU (cached for the other blocks in that CU).  See
+        L{_parse_ldevs} for the record format. """
+        if self.ldev_info is None:
+            cu = self.ldevs[0][0:2]
+            if self.module.params["query_scope"] == "cu":
+                key = self.horcm+":"+cu
+                if key not in LDEVBlock._cu_cache:
+                    LDEVBlock._cu_cache[key] = self._get_ldev_range(cu+":00", 256)
+                ldev_info = LDEVBlock._cu_cache[key]
             else:
-                output = self._run_cmd(cmd)
-                self.msg.append(cmd)
-                if len(output) != 0:
-                    self.msg.append(output)
+                ldev_info = self._get_ldev_range(self.ldevs[0], len(self.ldevs))
+            self.ldev_info = dict()
+            for ldev_id in self.ldevs:
+                # LDEVs missing from the query output are treated as undefined
+                self.ldev_info[ldev_id] = ldev_info.get(ldev_id, {
+                    "defined": False, "name": None, "capacity": None,
+                    "pool": None, "ports": [] })
+        return self.ldev_info
+
+    def _get_ldev_range(self, begin, count):
+        output = self._run_cmd("get ldev -ldev_id "+begin+" -cnt "+str(count)+
+                               " -I"+self.horcm)
+        return self._parse_ldevs(output)
+
+    @staticmethod
+    def _parse_ldevs(output):
+        """ Parse the output of a (ranged) C{raidcom get ldev} into a dictionary
+        of LDEV ids mapped to records:
+
+        { "6C:48": { "defined": True, "name": "MYNAME_01",
+                     "capacity": "104857600", "pool": "36",
+                     "ports": [ { "port": "CL1-B-0", "lun": "1",
+                                  "host": "todd-pri" } ] } }
+        """
+        result = dict()
+        record = None
+        for line in output.splitlines():
+            if ":" not in line:
+                continue
+            key, value = [ f.strip() for f in line.split(":", 1) ]
+            if key == "Serial#":
+                record = { "defined": True, "name": None, "capacity": None,
+                           "pool": None, "ports": [] }
+            elif record is None:
+                continue
+            elif key == "LDEV":
+                hex_id = format(int(value.split()[0]), "04X")
+                result[hex_id[:2]+":"+hex_id[2:]] = record
+            elif key == "VOL_TYPE":
+                record["defined"] = re.search(r"NOT DEFINED", value) is None
+            elif key == "LDEV_NAMING":
+                record["name"] = value
+            elif key == "VOL_Capacity(BLK)":
+                record["capacity"] = value
+            elif key == "B_POOLID":
+                record["pool"] = value
+            elif key == "PORTs":
+                for glob in value.split(":"):
+                    fields = glob.split()
+                    if len(fields) < 3:
+                        continue
+                    record["ports"].append({ "port": fields[0], "lun": fields[1],
+                                             "host": fields[2] })
+        return result
 
     def _run_cmd(self, cmd):
-        stdout = self.module.run_command(self.RAIDCOM+" "+cmd, check_rc = True)[1]
-        return stdout.strip()
+        rc, output = self.run_raidcom(self.module, cmd)
+        if rc != 0:
+            self.msg.append("FAILED: "+self.RAIDCOM+" "+cmd+" (rc "+str(rc)+")")
+            self.module.fail_json(msg = " | ".join(self.msg), rc = rc,
+                                  cmd = self.RAIDCOM+" "+cmd, stdout = output)
+        return output
+
+    @staticmethod
+    def run_raidcom(module, cmd):
+        """ Run one raidcom command, returning a tuple of (rc, output).  The
+        command line is split into an argument list, so block names and ports
+        are never parsed by a shell. """
+        rc, stdout, stderr = module.run_command([ LDEVBlock.RAIDCOM ]+shlex.split(cmd))
+        return rc, (stdout+stderr).strip()
+
+class RaidcomPlan:
+    """ Collects raidcom operations from any number of blocks and runs them
+    under as few meta_resource lock windows as possible.  An operation is a
+    list of commands that is never split across windows.
+
+    With a C{lock_window} of N seconds the lock is released and taken again
+    between operations whenever the next operation (estimated from the
+    slowest one so far) would keep the current window open past N seconds,
+    so that the lock is never held beyond its C{LOCK_TIME} lease. """
+    LOCK_TIME = 60
+
+    def __init__(self, module):
+        self.module = module
+        self.horcm = self.module.params["horcm"]
+        self.window = self.module.params["lock_window"]
+        self.lock_cmd = ("lock resource -resource_name meta_resource -time "+
+                         str(self.LOCK_TIME)+" -I"+self.horcm)
+        self.unlock_cmd = "unlock resource -resource_name meta_resource -I"+self.horcm
+        self.ops = []
+        self.msg = []
+        self.changed = False
+        self.locked = False
+
+    def add(self, cmd_list, check = None):
+        """ Add an operation.  If C{check} is given, failing commands in the
+        operation do not abort the run; instead C{check} is called with a list
+        of (cmd, rc, output) tuples once the operation has run and returns an
+        error message, or None if the operation succeeded. """
+        if len(cmd_list) != 0:
+            self.ops.append((cmd_list, check))
+
+    def execute(self):
+        if len(self.ops) == 0:
+            return
+        self.msg.append("raidcom commands: ")
+        window_start = None
+        slowest_op = 0
+        for cmd_list, check in self.ops:
+            if window_start is not None:
+                if time.time()-window_start+slowest_op > self.window:
+                    self._run(self.unlock_cmd)
+                    window_start = None
+            if window_start is None:
+                self._run(self.lock_cmd)
+                window_start = time.time()
+            op_start = time.time()
+            results = []
+            for cmd in cmd_list:
+                rc, output = self._run(cmd, check_rc = check is None)
+                results.append((cmd, rc, output))
+            if check is not None and not self.module.check_mode:
+                error = check(results)
+                if error is not None:
+                    self._fail(error, cmd_list[-1], 1, "")
+            slowest_op = max(slowest_op, time.time()-op_start)
+        self._run(self.unlock_cmd)
+        self.ops = []
+        self.changed = True
+
+    def _run(self, cmd, check_rc = True):
+        if self.module.check_mode:
+            self.msg.append(LDEVBlock.RAIDCOM+" "+cmd)
+            return 0, ""
+        rc, output = LDEVBlock.run_raidcom(self.module, cmd)
+        self.msg.append(cmd)
+        if len(output) != 0:
+            self.msg.append(output)
+        if cmd == self.lock_cmd:
+            self.locked = rc == 0
+        elif cmd == self.unlock_cmd:
+            self.locked = False
+        if rc != 0 and check_rc:
+            self._fail(LDEVBlock.RAIDCOM+" "+cmd+" (rc "+str(rc)+")", cmd, rc, output)
+        return rc, output
+
+    def _fail(self, error, cmd, rc, output):
+        # don't leave the resource locked until the lease expires
+        if self.locked:
+            LDEVBlock.run_raidcom(self.module, self.unlock_cmd)
+        self.msg.append("FAILED: "+error)
+        self.module.fail_json(msg = " | ".join(self.msg), rc = rc,
+                              cmd = LDEVBlock.RAIDCOM+" "+cmd, stdout = output)
+
+class HDSInventory:
+    """ Index of every HDS device visible on this host, built from a single
+    inqraid pass.  Records are keyed by LDEV name, device node, CU:LDEV and
+    frame serial:
+
+    { "device": "c0t60060E80166BCD0000016BCD00006DE0d0s2", "port": "CL1-B",
+      "serial": "93133", "ldev": "6D:E0", "name": "MYNAME_01" }
+    """
+    INQRAID = "/HORCM/usr/bin/inqraid"
+    RECORD_KEYS = [ "device", "port", "serial", "ldev", "name" ]
+    RDSK_DIR = "/dev/rdsk"
+
+    def __init__(self):
+        # every record in the order inqraid reported it
+        self.records = []
+        self.by_name = {}
+        self.by_device = {}
+        self.by_ldev = {}
+        self.by_serial = {}
+        self.cmd_devices = {}
+        self.scanned = False
+        self._cm_lines = []
+        self._cm_complete = False
+
+    def load(self, cache_file):
+        """ Index the records saved in C{cache_file} by L{scan}, provided the
+        device directory has not changed since.  Returns True if the index was
+        loaded. """
+        stamp = self._rdsk_stamp()
+        cache = self._load_json(cache_file)
+        if stamp is None or cache.get("stamp") != stamp or not isinstance(cache.get("records"), list):
+            return False
+        for columns in cache["records"]:
+            if not isinstance(columns, list) or len(columns) != len(self.RECORD_KEYS):
+                return False
+        for columns in cache["records"]:
+            self._add_record(dict(zip(self.RECORD_KEYS, columns)))
+        self.scanned = True
+        return True
+
+    def scan(self, cache_file = None):
+        """ Run inqraid across all device nodes and index the result.  If
+        C{cache_file} is given, the index is saved there for L{load} to reuse
+        in later runs for as long as the device directory is unchanged. """
+        stamp = self._rdsk_stamp()
+        try:
+            for line in self._inqraid(["-fnx", "-CLI"]):
+                self._add_line(line)
+        except (subprocess.CalledProcessError, OSError) as e:
+            print "Unable to scan for backend devices: "+str(e)
+            exit(1)
+        self.scanned = True
+        if cache_file is not None and stamp is not None:
+            # saved in scan order, so that where several device nodes show
+            # the same LDEV name a cached run picks the same one as a scan
+            records = [ [ r[key] for key in self.RECORD_KEYS ] for r in self.records ]
+            self._save_json(cache_file, { "stamp": stamp, "records": records })
+
+    def _device_nodes(self):
+        """ Yield the path of every node in the device directory, in C{ls}
+        order, without expanding them all onto one command line. """
+        for name in sorted(os.listdir(self.RDSK_DIR)):
+            yield os.path.join(self.RDSK_DIR, name)
+
+    def _inqraid(self, args):
+        """ Run inqraid with the device nodes streamed to its stdin from a
+        writer thread, yielding its output a line at a time.  Closing the
+        generator early stops inqraid; a failed run raises
+        C{CalledProcessError} once its output is exhausted. """
+        cmd = [ self.INQRAID ]+args
+        proc = subprocess.Popen(cmd, stdin = subprocess.PIPE, stdout = subprocess.PIPE)
+        def feed():
+            try:
+                for node in self._device_nodes():
+                    proc.stdin.write(node+"\n")
+            except (IOError, OSError):
+                # inqraid stopped reading, or the directory is unreadable
+                pass
+            finally:
+                try:
+                    proc.stdin.close()
+                except (IOError, OSError):
+                    pass
+        writer = threading.Thread(target = feed)
+        writer.daemon = True
+        writer.start()
+        finished = False
+        try:
+            for line in iter(proc.stdout.readline, ""):
+                yield line
+            finished = True
+        finally:
+            if not finished and proc.poll() is None:
+                proc.kill()
+            proc.stdout.close()
+            proc.wait()
+            writer.join()
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, " ".join(cmd))
+
+    def _rdsk_stamp(self):
+        """ Identify the current state of the device directory.  Adding or
+        removing a node changes the directory mtime and entry count. """
+        try:
+            st = os.stat(self.RDSK_DIR)
+            return [ st.st_mtime, st.st_nlink, len(os.listdir(self.RDSK_DIR)) ]
+        except OSError:
+            return None
+
+    def get_cmd_device(self, hex_serial, cache_file = None):
+        """ Return the command device node for the frame with the given hex
+        serial, or None if the host cannot see one.  Results are kept for the
+        life of the process and, if C{cache_file} is given, in that file; a
+        remembered device is only trusted while its device node exists. """
+        if hex_serial in self.cmd_devices:
+            return self.cmd_devices[hex_serial]
+        cache = dict()
+        if cache_file is not None:
+            cache = self._load_json(cache_file)
+            device = cache.get(hex_serial)
+            if device is not None and os.path.exists(os.path.join(self.RDSK_DIR, device)):
+                self.cmd_devices[hex_serial] = device
+                return device
+        if not self._cm_complete:
+            # -sort makes inqraid read every node before it prints anything,
+            # so the whole pass is read once and kept for the other serials
+            lines = self._inqraid(["-sort", "-CM", "-CLI"])
+            try:
+                for line in lines:
+                    line = line.strip()
+                    if line.startswith(self.RDSK_DIR+"/"):
+                        self._cm_lines.append(line)
+            except (subprocess.CalledProcessError, OSError) as e:
+                print "Unable to get command device: "+str(e)
+                exit(1)
+            self._cm_complete = True
+        self.cmd_devices[hex_serial] = None
+        for line in self._cm_lines:
+            if hex_serial in line:
+                self.cmd_devices[hex_serial] = self._cmd_device_node(line)
+                break
+        if cache_file is not None and self.cmd_devices[hex_serial] is not None:
+            cache[hex_serial] = self.cmd_devices[hex_serial]
+            self._save_json(cache_file, cache)
+        return self.cmd_devices[hex_serial]
+
+    def _cmd_device_node(self, line):
+        return line[len(self.RDSK_DIR)+1:].split()[0]
+
+    @staticmethod
+    def _load_json(cache_file):
+        return root_cache.load(cache_file)
+
+    @staticmethod
+    def _save_json(cache_file, cache):
+        root_cache.save(cache_file, cache, ".hds_inventory.")
+
+    def _add_line(self, line):
+        columns = line.split()
+        if len(columns) < 9 or columns[0] == "DEVICE_FILE":
+            return
+        tmp = columns[3].strip()
+        return self._add_record({ "device": columns[0].strip(),
+                           "port": columns[1].strip(),
+                           "serial": columns[2].strip(),
+                           "ldev": tmp[:2]+":"+tmp[2:],
+                           "name": columns[8].strip() })
+
+    def _add_record(self, record):
+        if record["device"] in self.by_device:
+            return self.by_device[record["device"]]
+        self.records.append(record)
+        self.by_name[record["name"]] = record
+        self.by_device[record["device"]] = record
+        self.by_ldev.setdefault(record["ldev"], []).append(record)
+        self.by_serial.setdefault(record["serial"], []).append(record)
+        return record
 
 def main():
     module = AnsibleModule(
         argument_spec = dict(
             horcm = dict(required = True, type = "str"),
-            blocks = dict(type = "list")
+            blocks = dict(type = "list"),
+            query_scope = dict(default = "block", choices = ["block", "cu"],
+                               type = "str"),
+            lock_window = dict(default = 50, type = "int"),
+            async_create = dict(default = False, type = "bool"),
+            trace_file = dict(default = None, type = "str")
         ),
         supports_check_mode = True
     )
+    tracing.install(module, "ldevblock")
 
     if platform.system() != "SunOS":
         module.fail_json(msg = "This module requires Solaris")
@@ -234,16 +668,24 @@ def main():
     if float(platform.version()) < 10:
         module.fail_json(msg = "This module requires Solaris 10 or higher")
 
+    if not 0 < module.params["lock_window"] < RaidcomPlan.LOCK_TIME:
+        module.fail_json(msg = "lock_window must be greater than 0 and less than the "+
+                         str(RaidcomPlan.LOCK_TIME)+" second lock lease")
+
     exit_msg = []
 
+    # plan every block first so all changes go through one set of lock windows
+    plan = RaidcomPlan(module)
     for block in module.params["blocks"]:
         ldb = LDEVBlock(module, block["name"], block["begin"], block["end"],
                         block["size"], block["ports"], block["pool"], block["chassis"])
-        ldb.create()
-        ldb.share()
+        ldb.plan_create(plan)
+        ldb.plan_share(plan)
         exit_msg.extend(ldb.msg)
+    plan.execute()
+    exit_msg.extend(plan.msg)
 
-    module.exit_json(changed = ldb.changed, msg = " | ".join(exit_msg))
+    module.exit_json(changed = plan.changed, msg = " | ".join(exit_msg))
 
 
 from ansible.module_utils.basic import *
@@ -1,188 +1,286 @@
 #!/usr/bin/python
 
-import subprocess, time, platform, socket, re
-
-NET_13_GW = "130.164.13.1"
-NET_13_MASK = "24"
-NET_51_LOOKUP = [ { "range": range(2, 63), "gw": "130.164.51.1", "mask": "26" },
-                  { "range": range(66, 127), "gw": "130.164.51.65", "mask": "26" },
-                  { "range": range(130, 159), "gw": "130.164.51.129", "mask": "27" },
-                  { "range": range(162, 191), "gw": "130.164.51.161", "mask": "27" },
-                  { "range": range(194, 255), "gw": "130.164.51.193", "mask": "27" } ]
+import subprocess, sys, time, platform, socket, re, struct
+sys.path.append("/home/clallen/work/autobuild/ansible_modules")
+import tracing
+
+DLADM = "/usr/sbin/dladm"
+IPADM = "/usr/sbin/ipadm"
+ROUTE = "/usr/sbin/route"
+SVCPROP = "/usr/bin/svcprop"
+SVCCFG = "/usr/sbin/svccfg"
+SVCADM = "/usr/sbin/svcadm"
+IPMPSTAT = "/usr/sbin/ipmpstat"
+PING = "/usr/sbin/ping"
+IPMP_FMRI = "svc:/network/ipmp:default"
+IDENTITY_FMRI = "svc:/system/identity:node"
+
 PRIV_MASK = "24"
 LINKNAME_MAP = [ ("net1", "publink0"), ("net2", "publink1"),
                  ("net3", "privlink0"), ("net4", "privlink1") ]
 IPMP_MAP = [ { "pubnet0": ("publink0", "publink1") },
              { "privnet0": ("privlink0", "privlink1") } ]
 
-def main():
-    module = AnsibleModule(argument_spec = dict(), supports_check_mode = True) 
-    changed = False
-    msg = []
+def _ip_to_int(addr):
+    try:
+        return struct.unpack("!I", socket.inet_aton(addr))[0]
+    except socket.error:
+        raise ValueError("invalid IPv4 address "+str(addr))
 
-    if platform.system() != "SunOS":
-        module.fail_json(msg = "This module requires Solaris")
+class SubnetTable:
+    """ Longest-prefix-match table of public subnets.
 
-    if module.check_mode:
-        msg.append('RUNNING IN CHECK MODE - NO CHANGES WILL BE MADE')
+    Subnets are kept in one dictionary per prefix length, keyed by network
+    address, so a lookup is at most 33 dictionary probes however many subnets
+    the table holds. """
+    def __init__(self, subnets):
+        self.by_prefix = dict()
+        for subnet in subnets:
+            try:
+                network, prefix = subnet["network"].split("/")
+                prefix = int(prefix)
+                gateway = subnet["gateway"]
+            except (KeyError, ValueError, AttributeError):
+                raise ValueError("subnet entry "+str(subnet)+" needs network (a.b.c.d/len) and gateway")
+            if prefix < 0 or prefix > 32:
+                raise ValueError("invalid prefix length in "+subnet["network"])
+            _ip_to_int(gateway)
+            mask = str(subnet.get("mask", prefix))
+            self.by_prefix.setdefault(prefix, dict())[_ip_to_int(network) & self._netmask(prefix)] = (gateway, mask)
+        self.prefixes = sorted(self.by_prefix.keys(), reverse = True)
 
-    pub_hostname = platform.node().replace("-mgmt", "")
-    priv_hostname = platform.node().replace("-mgmt", "-priv1")
+    @staticmethod
+    def _netmask(prefix):
+        return (0xffffffff << (32-prefix)) & 0xffffffff
 
-    # do DNS lookups
-    try:
-        pub_IP = socket.gethostbyname(pub_hostname)
-    except socket.gaierror as e:
-        module.fail_json(msg = "Error resolving public hostname "+pub_hostname+": "+e.strerror)
-    try:
-        priv_IP = socket.gethostbyname(priv_hostname)
-    except socket.gaierror as e:
-        module.fail_json(msg = "Error resolving private hostname "+priv_hostname+": "+e.strerror)
-    # check net range/get public gateway and mask
-    if re.match(r"130.164.13.", pub_IP) is not None:
-        pub_gw = NET_13_GW
-        pub_mask = NET_13_MASK
-    elif re.match(r"130.164.51.", pub_IP) is not None:
-        for net in NET_51_LOOKUP:
-            if int(pub_IP.split(".")[3]) in net["range"]:
-                pub_gw = net["gw"]
-                pub_mask = net["mask"]
-                break
-    else:
-        module.fail_json(msg = "Public IP "+pub_IP+" is not in a valid range")
+    def lookup(self, addr):
+        """ Return the (gateway, mask) of the most specific subnet holding
+        C{addr}, or None. """
+        addr = _ip_to_int(addr)
+        for prefix in self.prefixes:
+            match = self.by_prefix[prefix].get(addr & self._netmask(prefix))
+            if match is not None:
+                return match
+        return None
 
-    # get current links
+def _query(module, what, cmd):
     try:
-        cur_links = subprocess.check_output(["/usr/sbin/dladm", "show-link", "-po", "LINK"], stderr=subprocess.STDOUT).split()
+        return subprocess.check_output(cmd, stderr=subprocess.STDOUT)
     except subprocess.CalledProcessError as e:
-        module.fail_json(msg = "Error querying links: "+e.output.strip())
+        module.fail_json(msg = "Error querying "+what+": "+e.output.strip())
+
+def _parsable(output):
+    """ Split C{-p} output into fields, honouring backslash escaped colons. """
+    return [ [ f.replace("\\:", ":") for f in re.split(r"(?<!\\):", line) ]
+             for line in output.splitlines() if line ]
+
+def snapshot(module):
+    """ Collect the network state rac_net manages in a handful of queries:
+
+    { "links": { link: state },
+      "interfaces": { ifname: state },
+      "addresses": { ifname: [ addr, ... ] },
+      "default_routes": [ gateway, ... ],
+      "smf": { fmri: { property: value } } }
+    """
+    state = dict()
+    output = _query(module, "links", [DLADM, "show-linkprop", "-co", "LINK,VALUE", "-p", "state"])
+    state["links"] = dict((f[0], f[1]) for f in _parsable(output))
+    output = _query(module, "interfaces", [IPADM, "show-if", "-po", "IFNAME,STATE"])
+    state["interfaces"] = dict((f[0], f[1]) for f in _parsable(output))
+    output = _query(module, "addresses", [IPADM, "show-addr", "-po", "ADDROBJ,ADDR"])
+    state["addresses"] = dict()
+    for f in _parsable(output):
+        state["addresses"].setdefault(f[0].split("/")[0], []).append(f[1])
+    output = _query(module, "default route", [ROUTE, "-p", "show"])
+    state["default_routes"] = re.findall(r"\badd\s+(?:-net\s+)?default\s+(\S+)", output)
+    output = _query(module, "SMF properties", [SVCPROP, "-f", "-p", "config", IPMP_FMRI, IDENTITY_FMRI])
+    state["smf"] = dict()
+    for line in output.splitlines():
+        fields = line.split(None, 2)
+        if len(fields) < 3 or "/:properties/" not in fields[0]:
+            continue
+        fmri, prop = fields[0].split("/:properties/", 1)
+        state["smf"].setdefault(fmri, dict())[prop] = fields[2]
+    return state
+
+def _succeeds(cmd):
+    proc = subprocess.Popen(cmd, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
+    output = proc.communicate()[0]
+    return proc.returncode == 0, output
+
+def ipmp_group_ready(group):
+    """ True once IPMP group C{group} has at least one active interface. """
+    ok, output = _succeeds([IPMPSTAT, "-P", "-o", "GROUP,STATE", "-g"])
+    if not ok:
+        return False
+    states = dict((f[0], f[1]) for f in _parsable(output))
+    return states.get(group) in ("ok", "degraded")
+
+def address_ready(ifname):
+    """ True once an address on C{ifname} has reached the C{ok} state. """
+    ok, output = _succeeds([IPADM, "show-addr", "-po", "STATE", ifname])
+    return ok and "ok" in output.split()
+
+def gateway_ready(gateway):
+    """ True once C{gateway} answers a ping. """
+    return _succeeds([PING, gateway, "1"])[0]
+
+def wait_until(ready, args, timeout):
+    """ Poll C{ready(*args)} with exponential backoff until it returns True or
+    C{timeout} seconds have passed.  Returns a tuple of (ready, seconds waited). """
+    start = time.time()
+    delay = 0.25
+    while True:
+        if ready(*args):
+            return True, round(time.time()-start, 2)
+        elapsed = time.time()-start
+        if elapsed >= timeout:
+            return False, round(elapsed, 2)
+        time.sleep(min(delay, timeout-elapsed))
+        delay = min(delay*2, 4)
+
+def plan(state, pub_hostname, pub_addr, priv_addr, pub_gw):
+    """ Compute the changes needed to bring C{state} in line with the RAC
+    network layout.  C{state} is updated as each change is planned so that
+    later steps see the effect of earlier ones.  Returns a list of
+    C{{ "msg", "error", "cmds", "wait" }} dictionaries, where C{wait} is an
+    optional (description, check, args, fatal) readiness condition to poll
+    for once the commands have run. """
+    ops = []
+    def add(msg, error, cmds, wait = None):
+        ops.append({ "msg": msg, "error": error, "cmds": cmds, "wait": wait })
+
+    links = state["links"]
+    interfaces = state["interfaces"]
+    addresses = state["addresses"]
     # rename if necessary
     for names in LINKNAME_MAP:
-        if names[1] not in cur_links:
-            msg.append("Renaming link "+names[0]+" to "+names[1])
-            if not module.check_mode:
-                try:
-                    subprocess.check_output(["/usr/sbin/dladm", "rename-link", names[0], names[1]], stderr=subprocess.STDOUT)
-                except subprocess.CalledProcessError as e:
-                    module.fail_json(msg = "Error renaming link "+names[0]+" to "+names[1]+": "+e.output.strip())
-                else:
-                    changed = True
-
+        if names[1] not in links:
+            add("Renaming link "+names[0]+" to "+names[1],
+                "Error renaming link "+names[0]+" to "+names[1],
+                [[DLADM, "rename-link", names[0], names[1]]])
+            links[names[1]] = links.pop(names[0], "unknown")
     # create link IPs
     for names in LINKNAME_MAP:
-        try:
-            linkstate = subprocess.check_output(["/usr/sbin/dladm", "show-linkprop", "-co", "VALUE", "-p", "state", names[1]], stderr=subprocess.STDOUT).strip()
-        except subprocess.CalledProcessError as e:
-            module.fail_json(msg = "Error querying link "+names[1]+": "+e.output.strip())
-        if linkstate != "up":
-            msg.append("Creating IP on link "+names[1])
-            if not module.check_mode:
-                try:
-                    subprocess.check_output(["/usr/sbin/ipadm", "create-ip", names[1]], stderr=subprocess.STDOUT)
-                except subprocess.CalledProcessError as e:
-                    module.fail_json(msg = "Error creating IP on link "+names[1]+": "+e.output.strip())
-                else:
-                    changed = True
-
+        if links[names[1]] != "up":
+            add("Creating IP on link "+names[1], "Error creating IP on link "+names[1],
+                [[IPADM, "create-ip", names[1]]])
+            links[names[1]] = "up"
     # create IPMP interfaces
     for ipmp in IPMP_MAP:
-        try:
-            ifaces = subprocess.check_output(["/usr/sbin/ipadm", "show-if", "-po", "IFNAME"], stderr=subprocess.STDOUT).split()
-        except subprocess.CalledProcessError as e:
-            module.fail_json(msg = "Error querying interfaces: "+e.output.strip())
         ifname = ipmp.keys()[0]
-        if ifname not in ifaces:
-            msg.append("Building IPMP interface "+ifname)
-            if not module.check_mode:
-                try:
-                    links = ipmp[ifname]
-                    subprocess.check_output(["/usr/sbin/ipadm", "create-ipmp", "-i", ",".join(links), ifname], stderr=subprocess.STDOUT)
-                    time.sleep(5)
-                except subprocess.CalledProcessError as e:
-                    module.fail_json(msg = "Error building IPMP interface "+ifname+": "+e.output.strip())
-                else:
-                    changed = True
-
+        if ifname not in interfaces:
+            add("Building IPMP interface "+ifname, "Error building IPMP interface "+ifname,
+                [[IPADM, "create-ipmp", "-i", ",".join(ipmp[ifname]), ifname]],
+                wait = ("IPMP group "+ifname, ipmp_group_ready, (ifname,), True))
+            interfaces[ifname] = "failed"
     # create IP addresses
-    # pubnet
-    try:
-        ifstate = subprocess.check_output(["/usr/sbin/ipadm", "show-if", "-po", "STATE", "pubnet0"], stderr=subprocess.STDOUT).strip()
-    except subprocess.CalledProcessError as e:
-        module.fail_json(msg = "Error querying interface pubnet0: "+e.output.strip())
-    if ifstate != "ok":
-        msg.append("Creating IP address on interface pubnet0")
-        if not module.check_mode:
-            try:
-                subprocess.check_output(["/usr/sbin/ipadm", "create-addr", "-T", "static", "-a", "local="+pub_IP+"/"+pub_mask, "pubnet0"], stderr=subprocess.STDOUT)
-            except subprocess.CalledProcessError as e:
-                module.fail_json(msg = "Error creating IP address on interface pubnet0: "+e.output.strip())
-            else:
-                changed = True
-    # privnet
-    try:
-        ifstate = subprocess.check_output(["/usr/sbin/ipadm", "show-if", "-po", "STATE", "privnet0"], stderr=subprocess.STDOUT).strip()
-    except subprocess.CalledProcessError as e:
-        module.fail_json(msg = "Error querying interface privnet0: "+e.output.strip())
-    if ifstate != "ok":
-        msg.append("Creating IP address on interface privnet0")
-        if not module.check_mode:
-            try:
-                subprocess.check_output(["/usr/sbin/ipadm", "create-addr", "-T", "static", "-a", "local="+priv_IP+"/"+PRIV_MASK, "privnet0"], stderr=subprocess.STDOUT)
-            except subprocess.CalledProcessError as e:
-                module.fail_json(msg = "Error creating IP address on interface privnet0: "+e.output.strip())
-            else:
-                changed = True
-
+    for ifname, addr in [ ("pubnet0", pub_addr), ("privnet0", priv_addr) ]:
+        if interfaces[ifname] != "ok" and not addresses.get(ifname):
+            add("Creating IP address on interface "+ifname,
+                "Error creating IP address on interface "+ifname,
+                [[IPADM, "create-addr", "-T", "static", "-a", "local="+addr, ifname]],
+                wait = ("address on "+ifname, address_ready, (ifname,), True))
+            addresses[ifname] = [addr]
     # set IPMP transitive probing
-    try:
-        probe_state = subprocess.check_output(["/usr/bin/svcprop", "-p", "config/transitive-probing", "ipmp"], stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError as e:
-        module.fail_json(msg = "Error querying IPMP transitive probing: "+e.output.strip())
-    if probe_state == "false":
-        msg.append("Setting IPMP transitive probing")
-        if not module.check_mode:
-            try:
-                subprocess.check_output(["/usr/sbin/svccfg", "-s", "ipmp", "setprop", "config/transitive-probing", "=", "boolean:", "true"], stderr=subprocess.STDOUT)
-                subprocess.check_output(["/usr/sbin/svcadm", "restart", "ipmp"], stderr=subprocess.STDOUT)
-            except subprocess.CalledProcessError as e:
-                module.fail_json(msg = "Error setting IPMP transitive probing: "+e.output.strip())
-            else:
-                changed = True
-
+    if state["smf"].get(IPMP_FMRI, {}).get("config/transitive-probing") == "false":
+        add("Setting IPMP transitive probing", "Error setting IPMP transitive probing",
+            [[SVCCFG, "-s", "ipmp", "setprop", "config/transitive-probing", "=", "boolean:", "true"],
+             [SVCADM, "restart", "ipmp"]])
     # replace default route with public
-    try:
-        output = subprocess.check_output(["/usr/sbin/route", "-p", "show"], stderr=subprocess.STDOUT).split()
-        cur_gw = output[len(output)-1]
-    except subprocess.CalledProcessError as e:
-        module.fail_json(msg = "Error querying default route: "+e.output.strip())
-    if cur_gw != pub_gw:
-        msg.append("Setting default route to "+pub_gw)
-        if not module.check_mode:
-            try:
-                subprocess.check_output(["/usr/sbin/route", "-p", "add", "default", pub_gw], stderr=subprocess.STDOUT)
-                subprocess.check_output(["/usr/sbin/route", "-p", "delete", "default", cur_gw], stderr=subprocess.STDOUT)
-            except subprocess.CalledProcessError as e:
-                module.fail_json(msg = "Error setting default route: "+e.output.strip())
-            else:
-                changed = True
-
+    if state["default_routes"] != [pub_gw]:
+        cmds = []
+        if pub_gw not in state["default_routes"]:
+            cmds.append([ROUTE, "-p", "add", "default", pub_gw])
+        for gw in state["default_routes"]:
+            if gw != pub_gw:
+                cmds.append([ROUTE, "-p", "delete", "default", gw])
+        add("Setting default route to "+pub_gw, "Error setting default route", cmds,
+            wait = ("gateway "+pub_gw, gateway_ready, (pub_gw,), False))
     # set hostname identity property
+    if state["smf"].get(IDENTITY_FMRI, {}).get("config/nodename") != pub_hostname:
+        add("Setting hostname identity property to "+pub_hostname,
+            "Error setting hostname identity property",
+            [[SVCCFG, "-s", "identity:node", "setprop", "config/nodename", "=", "astring:", pub_hostname],
+             [SVCADM, "refresh", "identity:node"]])
+    return ops
+
+def main():
+    module = AnsibleModule(
+        argument_spec = dict(
+            wait_timeout = dict(type = "int", default = 60),
+            # public subnets, from group_vars rac_subnets
+            subnets = dict(type = "list", required = True),
+            pub_ip = dict(default = None),
+            priv_ip = dict(default = None),
+            trace_file = dict(default = None, type = "str")
+        ),
+        supports_check_mode = True
+    )
+    tracing.install(module, "rac_net")
+    changed = False
+    msg = []
+    waited = dict()
+
+    if platform.system() != "SunOS":
+        module.fail_json(msg = "This module requires Solaris")
+
+    if module.check_mode:
+        msg.append('RUNNING IN CHECK MODE - NO CHANGES WILL BE MADE')
+
+    pub_hostname = platform.node().replace("-mgmt", "")
+    priv_hostname = platform.node().replace("-mgmt", "-priv1")
+
+    # do DNS lookups, unless the play already resolved the names
+    pub_IP = module.params["pub_ip"]
+    priv_IP = module.params["priv_ip"]
+    if pub_IP is None:
+        try:
+            pub_IP = socket.gethostbyname(pub_hostname)
+        except socket.gaierror as e:
+            module.fail_json(msg = "Error resolving public hostname "+pub_hostname+": "+e.strerror)
+    if priv_IP is None:
+        try:
+            priv_IP = socket.gethostbyname(priv_hostname)
+        except socket.gaierror as e:
+            module.fail_json(msg = "Error resolving private hostname "+priv_hostname+": "+e.strerror)
+    # check net range/get public gateway and mask
     try:
-        cur_hostname = subprocess.check_output(["/usr/bin/svcprop", "-p", "config/nodename", "identity:node"], stderr=subprocess.STDOUT).strip()
-    except subprocess.CalledProcessError as e:
-        module.fail_json(msg = "Error querying current hostname identity property: "+e.output.strip())
-    if cur_hostname != pub_hostname:
-        msg.append("Setting hostname identity property to "+pub_hostname)
-        if not module.check_mode:
-            try:
-                subprocess.check_output(["/usr/sbin/svccfg", "-s", "identity:node", "setprop", "config/nodename", "=", "astring:", pub_hostname], stderr=subprocess.STDOUT)
-                subprocess.check_output(["/usr/sbin/svcadm", "refresh", "identity:node"], stderr=subprocess.STDOUT)
-            except subprocess.CalledProcessError as e:
-                module.fail_json(msg = "Error setting hostname identity property: "+e.output.strip())
+        subnets = SubnetTable(module.params["subnets"])
+    except ValueError as e:
+        module.fail_json(msg = "Invalid subnet table: "+str(e))
+    match = subnets.lookup(pub_IP)
+    if match is None:
+        module.fail_json(msg = "Public IP "+pub_IP+" is not in a valid range")
+    pub_gw, pub_mask = match
+
+    # build the plan from a single snapshot, then apply it
+    ops = plan(snapshot(module), pub_hostname, pub_IP+"/"+pub_mask,
+               priv_IP+"/"+PRIV_MASK, pub_gw)
+    for op in ops:
+        msg.append(op["msg"])
+        if module.check_mode:
+            continue
+        try:
+            for cmd in op["cmds"]:
+                subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError as e:
+            module.fail_json(msg = op["error"]+": "+e.output.strip())
+        else:
+            changed = True
+        if op["wait"] is not None:
+            what, ready, args, fatal = op["wait"]
+            ok, seconds = wait_until(ready, args, module.params["wait_timeout"])
+            waited[what] = seconds
+            if ok:
+                msg.append("Waited "+str(seconds)+"s for "+what)
+            elif fatal:
+                module.fail_json(msg = "Timed out after "+str(seconds)+"s waiting for "+what, waited = waited)
             else:
-                changed = True
+                msg.append("Gave up after "+str(seconds)+"s waiting for "+what)
 
-    module.exit_json(changed = changed, msg = " | ".join(msg))
+    module.exit_json(changed = changed, msg = " | ".join(msg), waited = waited)
 
 
 from ansible.module_utils.basic import *
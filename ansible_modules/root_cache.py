@@ -0,0 +1,55 @@
+""" JSON cache files shared by the autobuild modules.
+
+The modules run as root and act on what they read back from their caches, so
+a cache is only trusted if neither it nor its directory can have been written
+by anyone else: both must be owned by root (or by the user running the
+module) and must not be writable by group or other.  Anything else, like a
+file that cannot be parsed, is treated as an empty cache. """
+import os, stat, json, tempfile
+
+# default directory for the caches, created mode 0700 when first written
+CACHE_DIR = "/var/cache/autobuild"
+
+def _trusted(st):
+    return (st.st_uid in (0, os.geteuid()) and
+            not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH))
+
+def load(path):
+    """ Return the dictionary saved in C{path}, or an empty one if the file is
+    missing, untrusted or not a JSON object. """
+    try:
+        if not _trusted(os.stat(os.path.dirname(os.path.abspath(path)))):
+            return dict()
+        fd = os.open(path, os.O_RDONLY | getattr(os, "O_NOFOLLOW", 0))
+        fh = os.fdopen(fd)
+        try:
+            if not _trusted(os.fstat(fd)):
+                return dict()
+            cache = json.load(fh)
+        finally:
+            fh.close()
+    except (IOError, OSError, ValueError):
+        return dict()
+    if not isinstance(cache, dict):
+        return dict()
+    return cache
+
+def save(path, cache, prefix):
+    """ Write C{cache} to C{path} via a temporary file named with C{prefix}
+    and a rename, so concurrent runs never read a partial file.  The
+    directory is created if needed; nothing is written to one that L{load}
+    would not trust. """
+    cache_dir = os.path.dirname(os.path.abspath(path))
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, 0700)
+        if not _trusted(os.stat(cache_dir)):
+            return
+        fd, tmpname = tempfile.mkstemp(dir = cache_dir, prefix = prefix)
+        fh = os.fdopen(fd, "w")
+        json.dump(cache, fh)
+        fh.close()
+        os.rename(tmpname, path)
+    except (IOError, OSError):
+        # the caches only save time; failing to write one is not an error
+        pass
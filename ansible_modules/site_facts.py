@@ -1,28 +1,133 @@
 #!/usr/bin/python
 
-import subprocess
+import subprocess, sys, os, time
+sys.path.append("/home/clallen/work/autobuild/ansible_modules")
+import tracing, root_cache
+
+PKG = "/bin/pkg"
+LDM = "/usr/sbin/ldm"
+IPMPSTAT = "/usr/sbin/ipmpstat"
+FACT_TYPES = [ "repos", "ldoms", "san", "net" ]
+CACHE_FILE = os.path.join(root_cache.CACHE_DIR, "site_facts.json")
 
 def _run_cmd(cmd, module):
     try:
-        return subprocess.check_output(cmd, shell = True).strip()
+        return subprocess.check_output(cmd, stderr = subprocess.STDOUT)
     except subprocess.CalledProcessError as e:
-        module.fail_json(msg = "Command '"+e.cmd+"' failed: "+e.output)
+        module.fail_json(msg = "Command '"+" ".join(e.cmd)+"' failed: "+e.output)
+
+def repo_facts(module):
+    """ Publishers and their origins from a single C{pkg publisher} call. """
+    publishers = dict()
+    output = _run_cmd([PKG, "publisher", "-H", "-F", "tsv"], module)
+    for line in output.splitlines():
+        # PUBLISHER STICKY SYSPUB ENABLED TYPE STATUS URI PROXY
+        fields = line.split("\t")
+        if len(fields) < 7:
+            continue
+        publisher = publishers.setdefault(fields[0], { "origins": [], "mirrors": [] })
+        if fields[4] in ("origin", "mirror"):
+            publisher[fields[4]+"s"].append(fields[6])
+    facts = { "publishers": publishers }
+    for name in ("solaris", "site"):
+        origins = publishers.get(name, {}).get("origins", [])
+        facts["current_"+name+"_repo"] = origins[0] if origins else ""
+    return facts
+
+def ldom_facts(module):
+    """ Every domain on this control domain with its state and its disk and
+    network devices. """
+    from solaris_ldom import parse_ldm_list
+    ldoms = dict()
+    for line in _run_cmd([LDM, "list", "-p"], module).splitlines():
+        if not line.startswith("DOMAIN|"):
+            continue
+        fields = dict(f.split("=", 1) for f in line.split("|")[1:] if "=" in f)
+        if "name" not in fields:
+            continue
+        ldoms[fields.get("name")] = dict((k, v) for k, v in fields.items() if k != "name")
+    devices = parse_ldm_list(_run_cmd([LDM, "list", "-p", "-o", "disk,network"], module))
+    for name, domain in devices.items():
+        ldoms.setdefault(name, dict()).update((key, domain[key])
+                                              for key in ("vds", "vdisk", "vnet"))
+    return { "ldoms": ldoms }
+
+def san_facts(module):
+    """ HDS devices visible to this host, keyed by LDEV name. """
+    from ldevblock import LDEVBlock
+    return { "san_devices": LDEVBlock.inventory().by_name }
+
+def net_facts(module):
+    """ Link, interface, address, route and IPMP group state. """
+    import rac_net
+    facts = rac_net.snapshot(module)
+    facts["ipmp_groups"] = dict()
+    output = _run_cmd([IPMPSTAT, "-P", "-o", "GROUP,STATE,INTERFACES", "-g"], module)
+    for fields in rac_net._parsable(output):
+        facts["ipmp_groups"][fields[0]] = { "state": fields[1],
+                                            "interfaces": fields[2].split() if len(fields) > 2 else [] }
+    return { "net": facts }
+
+COLLECTORS = { "repos": repo_facts, "ldoms": ldom_facts, "san": san_facts, "net": net_facts }
+
+def cached_facts(cache, fact_type, now, ttl):
+    """ Return the facts of C{fact_type} saved in C{cache} if they are
+    younger than C{ttl} seconds, otherwise None.  An entry of the wrong
+    shape is a miss. """
+    entry = cache.get(fact_type)
+    if not isinstance(entry, dict) or not isinstance(entry.get("facts"), dict):
+        return None
+    if not isinstance(entry.get("time"), (int, long, float)):
+        return None
+    if ttl <= 0 or now-entry["time"] >= ttl:
+        return None
+    return entry["facts"]
 
 def main():
     module = AnsibleModule(
         argument_spec = dict(
-            types = dict(required = True, type = "list")
+            types = dict(required = True, type = "list"),
+            cache_ttl = dict(default = 300, type = "int"),
+            cache_file = dict(default = CACHE_FILE, type = "str"),
+            invalidate = dict(default = [], type = "list"),
+            trace_file = dict(default = None, type = "str")
         ),
         supports_check_mode = False
     )
+    tracing.install(module, "site_facts")
+
+    for fact_type in module.params["types"]:
+        if fact_type not in FACT_TYPES:
+            module.fail_json(msg = "Unknown fact type "+fact_type+", must be one of "+", ".join(FACT_TYPES))
+    for fact_type in module.params["invalidate"]:
+        if fact_type not in FACT_TYPES+["all"]:
+            module.fail_json(msg = "Unknown fact type "+fact_type+" to invalidate")
 
     data = { "ansible_facts": {} }
+    cache_file = module.params["cache_file"]
+    cache_ttl = module.params["cache_ttl"]
+
+    cache = root_cache.load(cache_file)
+    if "all" in module.params["invalidate"]:
+        cache = dict()
+    for fact_type in module.params["invalidate"]:
+        cache.pop(fact_type, None)
+
+    now = time.time()
+    cached = []
+    for fact_type in module.params["types"]:
+        facts = cached_facts(cache, fact_type, now, cache_ttl)
+        if facts is not None:
+            cached.append(fact_type)
+        else:
+            facts = COLLECTORS[fact_type](module)
+            cache[fact_type] = { "time": now, "facts": facts }
+        data["ansible_facts"].update(facts)
 
-    if "repos" in module.params["types"]:
-        # get current repos
-        data["ansible_facts"]["current_solaris_repo"] = _run_cmd("/bin/pkg publisher solaris | /bin/grep Origin | /bin/awk '{print $3}'", module)
-        data["ansible_facts"]["current_site_repo"] = _run_cmd("/bin/pkg publisher site | /bin/grep Origin | /bin/awk '{print $3}'", module)
+    if cache_ttl > 0 or module.params["invalidate"]:
+        root_cache.save(cache_file, cache, ".site_facts.")
 
+    data["cached"] = cached
     module.exit_json(**data)
 
 
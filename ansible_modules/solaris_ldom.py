@@ -1,11 +1,21 @@
 #!/usr/bin/python
 
-import platform, subprocess, sys, re
+import platform, subprocess, sys, re, json, threading
 sys.path.append("/opt/local/scripts/production/ovm/lib/python2.7/site-packages")
 sys.path.append("/home/clallen/work/autobuild/ansible_modules")
 from agent.lib.ldoms.ldmxml import LDMXMLConnection
 from agent.lib.ldoms.ldmxml import LDMError
 from ldevblock import LDEVBlock
+import tracing
+
+LDM = "/usr/sbin/ldm"
+# domain providing ldmd and the primary virtual services
+CONTROL_DOMAIN = "primary"
+# options that may be given per domain in the "domains" list
+DOMAIN_OPTIONS = [ "name", "state", "cpu_arch", "cores", "memory", "domain_vars",
+                   "vdisks", "vnets", "rac_storage", "horcminst", "reconcile" ]
+CFGADM = "/usr/sbin/cfgadm"
+SSH = "/usr/bin/ssh"
 
 DOCUMENTATION = """
 ---
@@ -18,9 +28,31 @@ requirements:
     - Solaris 11.3 or higher
 options:
     name:
-        required: true
+        required: false
         description:
             - Domain name.  If the domain does not exist, it will be created.
+              Required unless C(domains) is given.
+    domains:
+        required: false
+        type: C{list} of C{dict}
+        description:
+            - Configure several domains in one run.  Each dictionary must have
+              a "name" entry and may have any of the per-domain options
+              (state, cpu_arch, cores, memory, domain_vars, vdisks, vnets,
+              rac_storage, horcminst, reconcile), checked and converted like
+              the top-level options; options not given take the value set at
+              the top level.  The SAN rescan and device inventory are shared
+              by all domains.  If C(parallel) is 1, the domains after one that
+              fails are skipped and reported as failed.
+    parallel:
+        required: false
+        type: C{int}
+        description:
+            - With C(domains), the number of domains to configure at the same
+              time.  Each worker, and each thread adding a service domain's
+              vdsdevs, uses an LDM connection of its own, so up to two
+              connections per worker are open to the local ldmd.
+        default: 1
     state:
         required: false
         description:
@@ -117,6 +149,47 @@ options:
         type: C{int}
         description:
             - The HORCM instance (used only with the "rac_storage" option).
+    cmd_device_cache:
+        required: false
+        type: C{str}
+        description:
+            - File in which to remember each storage frame's command device
+              between runs (used only with the "rac_storage" option).  A
+              remembered device is used only while its device node still
+              exists, and the file only if it and its directory are owned by
+              root and not writable by group or other; otherwise the host is
+              searched again.
+    inventory_cache:
+        required: false
+        type: C{str}
+        description:
+            - File in which the HDS device inventory is kept between runs, for
+              as long as /dev/rdsk is unchanged (used only with the
+              "rac_storage" option).  The file and its directory must be
+              owned by root and not writable by group or other, or the host
+              is scanned again.  An empty string disables the cache.
+        default: /var/cache/autobuild/hds_inventory.json
+    reconcile:
+        required: false
+        type: C{bool}
+        description:
+            - Read the state, cores, memory, variables, vdisks, vnets and VDS
+              volumes of every domain with one C{ldm list}, and only change
+              what differs from the requested options instead of setting
+              everything and ignoring "already exists" errors.  Vdisks and
+              vnets of the domain that are not requested are removed, along
+              with the VDS volumes no other vdisk uses.  Changes are made with
+              the ldm command.
+        default: false
+    trace_file:
+        required: false
+        type: C{str}
+        description:
+            - File on the target to which every command and ldmd request the
+              module makes is appended as a JSON line (command, duration, exit
+              status and byte counts) as soon as it finishes.  The same
+              records are always returned in the C{timings} result.
+        default: null
 """
 
 EXAMPLES = """
@@ -173,6 +246,15 @@ solaris_ldom:
     rac_storage: [ "DEV_ENV_1", "TEST_ENV_2" ]
     horcminst: 5
 
+# Create two RAC nodes in one run, two at a time
+solaris_ldom:
+    cores: 2
+    memory: 16
+    rac_storage: [ "DEV_ENV_1" ]
+    horcminst: 5
+    parallel: 2
+    domains: [ { "name": "devrac1" }, { "name": "devrac2", "memory": 32 } ]
+
 # Change properties of an existing domain (state stays the same if not
 # specified)
 solaris_ldom:
@@ -185,23 +267,146 @@ solaris_ldom: name="{{ldom_name}}" domain_vars={ "boot-file": }
 """
 
 
+def ldm_connection():
+    """ Open a connection to ldmd whose requests are recorded in the module's
+    timings. """
+    return tracing.TracedClient(LDMXMLConnection(), "ldmd")
+
+class LDMConnections:
+    """ A pool of connections to the ldmd of the control domain, which manages
+    the service domains as well.  A thread takes a connection with L{get} and
+    gives it back with L{put}, so a connection is never used by two threads
+    at once; one is opened only when none is idle. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = []
+
+    def get(self):
+        with self.lock:
+            if len(self.idle) != 0:
+                return self.idle.pop()
+        return ldm_connection()
+
+    def put(self, connection):
+        with self.lock:
+            self.idle.append(connection)
+
+def service_domain(service):
+    """ Return the domain providing a virtual service, which by convention is
+    named after it (primary-vds0 is provided by primary). """
+    return service.split("-", 1)[0]
+
+def parse_ldm_list(output):
+    """ Parse C{ldm list -p -o domain,core,memory,disk,network} output into a
+    dictionary keyed by domain name:
+
+    { "primary": { "state": "active", "cores": 4, "memory": 17179869184,
+                   "vars": {},
+                   "vds": { "primary-vds0": { "vol1": { "dev": "/dev/dsk/...",
+                                                        "mpgroup": "grp" } } },
+                   "vdisk": {}, "vnet": {} },
+      "ldg1": { "state": "bound", "cores": 2, "memory": 17179869184,
+                "vars": { "boot-device": "disk" }, "vds": {},
+                "vdisk": { "rootdisk0": { "vol": "vol1@primary-vds0", "id": "0" } },
+                "vnet": { "mgmt0": { "service": "primary-vsw0@primary",
+                                     "pvid": "1", "mtu": "1500", "id": "0" } } } }
+    """
+    result = dict()
+    domain = None
+    section = None
+    vds = None
+    for line in output.splitlines():
+        fields = line.split("|")
+        props = dict(f.split("=", 1) for f in fields[1:] if "=" in f)
+        if fields[0] == "DOMAIN":
+            domain = result.setdefault(props["name"], { "state": props.get("state", ""),
+                                                        "cores": 0, "memory": 0,
+                                                        "vars": {}, "vds": {},
+                                                        "vdisk": {}, "vnet": {} })
+            section = None
+            continue
+        elif domain is None:
+            continue
+        if fields[0] != "":
+            section = fields[0]
+            vds = None
+        if section == "CORE" and "cid" in props:
+            domain["cores"] += 1
+        elif section == "MEMORY" and "size" in props:
+            domain["memory"] += int(props["size"])
+        elif section == "VARIABLES" and fields[0] == "":
+            domain["vars"].update(props)
+        elif section == "VDS" and fields[0] == "VDS":
+            vds = domain["vds"].setdefault(props["name"], {})
+        elif section == "VDS" and vds is not None and "vol" in props:
+            vds[props["vol"]] = { "dev": props.get("dev", ""),
+                                  "mpgroup": props.get("mpgroup", "") }
+        elif section == "VDISK":
+            domain["vdisk"][props["name"]] = { "vol": props.get("vol", ""),
+                                               "id": props.get("id", "") }
+        elif section == "VNET":
+            domain["vnet"][props["name"]] = { "service": props.get("service", ""),
+                                              "pvid": props.get("pvid", ""),
+                                              "mtu": props.get("mtu", ""),
+                                              "id": props.get("id", "") }
+    return result
+
+def by_service_domain(items):
+    """ Group tuples whose first element is a service domain into a list of
+    (service domain, tuples), keeping their order. """
+    groups = []
+    for item in items:
+        for domain, group in groups:
+            if domain == item[0]:
+                group.append(item)
+                break
+        else:
+            groups.append((item[0], [ item ]))
+    return groups
+
+def run_threads(target, args_list):
+    """ Call C{target} with each argument tuple in its own thread and wait for
+    all of them. """
+    threads = [ threading.Thread(target = target, args = args) for args in args_list ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+class LDOMFailure(Exception):
+    pass
+
 class LDOM:
-    def __init__(self, module):
+    def __init__(self, module, params = None, connections = None):
         self.module = module
-        self.name = self.module.params["name"]
-        self.cores = self.module.params["cores"]
-        self.cpu_arch = self.module.params["cpu_arch"]
-        self.memory = self.module.params["memory"]
-        self.domain_vars = self.module.params["domain_vars"]
-        self.vdisks = self.module.params["vdisks"]
-        self.vnets = self.module.params["vnets"]
-        self.rac_storage = self.module.params["rac_storage"]
-        self.horcminst = self.module.params["horcminst"]
+        if params is None:
+            params = self.module.params
+        self.name = params["name"]
+        self.state = params["state"]
+        self.cores = params["cores"]
+        self.cpu_arch = params["cpu_arch"]
+        self.memory = params["memory"]
+        self.domain_vars = params["domain_vars"]
+        self.vdisks = params["vdisks"]
+        self.vnets = params["vnets"]
+        self.rac_storage = params["rac_storage"]
+        self.horcminst = params["horcminst"]
+        self.reconcile = params["reconcile"]
 
         self.changed = False
         self.msg = []
+        self.failure = None
 
-        self.lxc = LDMXMLConnection()
+        if connections is None:
+            connections = LDMConnections()
+        self.connections = connections
+        # taken from the pool when first used and given back by configure()
+        self._lxc = None
+        # parsed "list" output for the domain, refreshed only after changes
+        self._snapshot = None
+        self._snapshot_valid = False
+        self._bindings = None
 
         self.node_id = self.name[-1]
         # VDS used for each node is one less than its ID
@@ -211,33 +416,95 @@ class LDOM:
         if self.module.check_mode:
             self.msg.append('RUNNING IN CHECK MODE - NO CHANGES WILL BE MADE')
 
+    @property
+    def lxc(self):
+        """ The ldmd connection of this domain, taken from the pool on first
+        use, so a reconcile that has nothing to change opens none. """
+        if self._lxc is None:
+            self._lxc = self.connections.get()
+        return self._lxc
+
+    def _put_lxc(self):
+        if self._lxc is not None:
+            self.connections.put(self._lxc)
+            self._lxc = None
+
+    def fail(self, msg):
+        """ Abort work on this domain.  Raised rather than calling fail_json
+        so that domains configured in parallel can report their own
+        failures. """
+        raise LDOMFailure(msg)
+
+    def configure(self):
+        """ Bring the domain to its requested configuration and state,
+        recording any failure in C{failure}. """
+        try:
+            if self.state == "deleted":
+                self.delete()
+                return
+            if not self.exists():
+                self.create()
+
+            if self.cores is not None:
+                self.set_cores()
+            if self.memory is not None:
+                self.set_memory()
+            if self.domain_vars is not None:
+                self.set_vars()
+            if self.rac_storage is not None and not self.module.check_mode:
+                # the RAC disks are set up, and reconciled, with any others
+                self.vdisks = ((self.vdisks or [])+self.rac_OS_disks()+
+                               self.rac_env_disks())
+            if self.vdisks is not None:
+                self.set_vdisks()
+            if self.vnets is not None:
+                self.set_vnets()
+
+            if self.state == "active":
+                self.state_active()
+            elif self.state == "bound":
+                self.state_bound()
+            elif self.state == "inactive":
+                self.state_inactive()
+        except LDOMFailure as e:
+            self.failure = str(e)
+        finally:
+            self._put_lxc()
+
     def create(self):
         if not self.module.check_mode:
             try:
                 self.lxc.create(self.name, cpu_arch=self.cpu_arch)
             except LDMError as e:
-                self.module.fail_json(msg = "Unable to create domain:"+
-                                      str(e))
+                self.fail("Unable to create domain:"+
+                          str(e))
             else:
                 self.changed = True
+            finally:
+                self.invalidate()
         self.msg.append("Domain created")
 
     def delete(self):
         if not self.exists():
-            self.module.fail_json(msg = "Domain does not exist, cannot delete")
+            self.fail("Domain does not exist, cannot delete")
         elif not self.module.check_mode:
-            if self.is_active:
-                self.state_inactive()
+            # a bound domain has to be unbound too; state_inactive checks
+            # the state itself
+            self.state_inactive()
             try:
                 self.lxc.destroy(self.name)
             except LDMError as e:
-                self.module.fail_json(msg = "Unable to delete domain:"+
-                                      str(e))
+                self.fail("Unable to delete domain:"+
+                          str(e))
             else:
                 self.changed = True
+            finally:
+                self.invalidate()
         self.msg.append("Domain deleted")
 
     def set_cores(self):
+        if self.reconcile and self._current("cores") == self.cores:
+            return
         if not self.module.check_mode:
             try:
                 self.lxc.set_core(self.name, self.cores)
@@ -246,9 +513,13 @@ class LDOM:
                 return
             else:
                 self.changed = True
+            finally:
+                self.invalidate()
         self.msg.append("Cores set to: "+str(self.cores))
 
     def set_memory(self):
+        if self.reconcile and self._current("memory") == self.memory*1024*1024*1024:
+            return
         if not self.module.check_mode:
             try:
                 self.lxc.set_memory(self.name, self.memory*1024*1024*1024)
@@ -257,18 +528,30 @@ class LDOM:
                 return
             else:
                 self.changed = True
+            finally:
+                self.invalidate()
         self.msg.append("Memory set to: "+str(self.memory)+"G")
 
     def set_vars(self):
+        variables = self.domain_vars
+        if self.reconcile:
+            current = self._current("vars") or {}
+            variables = dict((name, value) for name, value in variables.iteritems()
+                             if (value is None and name in current) or
+                             (value is not None and current.get(name) != str(value)))
+            if len(variables) == 0:
+                return
         if not self.module.check_mode:
             try:
-                self.lxc.update_variables(self.name, self.domain_vars)
+                self.lxc.update_variables(self.name, variables)
             except LDMError as e:
                 self.msg.append("Unable to set domain variables: "+str(e))
                 return
             else:
                 self.changed = True
-        for varname, varval in self.domain_vars.iteritems():
+            finally:
+                self.invalidate()
+        for varname, varval in variables.iteritems():
             if varval is None:
                 self.msg.append("Removed variable '"+varname+"'")
             else:
@@ -276,6 +559,7 @@ class LDOM:
 
     def set_vdisks(self):
         missing_cfg = False
+        valid = []
         for vdisk in self.vdisks:
             if vdisk["vdisk"] is None:
                 self.msg.append("COULD NOT ADD VDISK - VDISK NAME REQUIRED")
@@ -301,29 +585,24 @@ class LDOM:
                 self.msg.append("COULD NOT ADD VDISK - MPGROUP REQUIRED")
                 missing_cfg = True
                 break
-            if not self.module.check_mode:
-                try:
-                    self.lxc.add_vdsdev(vdisk["vds"], vdisk["volume"],
-                                        vdisk["backend"],
-                                        mpgroup=vdisk["mpgroup"],
-                                        shared=True)
-                    if not re.match(r"^secondary", vdisk["vds"]):
-                        self.lxc.add_vdisk(self.name, vdisk["vdisk"], vdisk["vds"],
-                                           volume=vdisk["volume"], id=vdisk["id"])
-                except LDMError as e:
-                    if re.search("already exists", str(e)) is None:
-                        self.module.fail_json(msg = str(e))
-                    else:
-                        self.msg.append(str(e))
-                else:
-                    self.changed = True
-        if not missing_cfg:
+            valid.append(vdisk)
+        if self.reconcile:
+            # a partial list would remove the devices left out of it
+            if not missing_cfg:
+                self._reconcile_vdisks(valid)
+        else:
+            # vdisks refer to their vdsdevs, so those are all added first
+            self._add_devices([ self._vdsdev_addition(vdisk) for vdisk in valid ],
+                              parallel = True)
+            self._add_devices([ self._vdisk_addition(vdisk) for vdisk in valid
+                                if not re.match(r"^secondary", vdisk["vds"]) ])
+        if not missing_cfg and not self.reconcile:
             for vdisk in self.vdisks:
                 self.msg.append("Added vdisk: "+vdisk["vdisk"])
 
     def set_vnets(self):
         missing_cfg = False
-        mtu = 1500
+        valid = []
         for vnet in self.vnets:
             if vnet["vnet"] is None:
                 self.msg.append("COULD NOT ADD VNET - VNET NAME REQUIRED")
@@ -341,135 +620,372 @@ class LDOM:
                 self.msg.append("COULD NOT ADD VNET - ID REQUIRED")
                 missing_cfg = True
                 break
-            if "mtu" in vnet:
-                mtu = vnet["mtu"]
-            if not self.module.check_mode:
-                try:
-                    self.lxc.add_vnet(self.name, vnet["vnet"], vnet["vswitch"],
-                                      pvid = vnet["pvid"], id = vnet["id"],
-                                      mtu = mtu)
-                except LDMError as e:
-                    if re.search("already exists", str(e)) is None:
-                        self.module.fail_json(msg = str(e))
-                    else:
-                        self.msg.append(str(e))
-                else:
-                    self.changed = True
-        if not missing_cfg:
+            valid.append(vnet)
+        if self.reconcile:
+            # a partial list would remove the devices left out of it
+            if not missing_cfg:
+                self._reconcile_vnets(valid)
+        else:
+            self._add_devices([ self._vnet_addition(vnet) for vnet in valid ])
+        if not missing_cfg and not self.reconcile:
             for vnet in self.vnets:
                 self.msg.append("Added vnet: "+vnet["vnet"])
 
-    def setup_rac_OS_disks(self):
-        if not self.module.check_mode:
-            devices = LDEVBlock.hds_scan(self.name, "device")
+    def _vdsdev_addition(self, vdisk):
+        return (service_domain(vdisk["vds"]), "vdsdev "+vdisk["volume"]+"@"+vdisk["vds"],
+                "add_vdsdev", (vdisk["vds"], vdisk["volume"], vdisk["backend"]),
+                { "mpgroup": vdisk["mpgroup"], "shared": True })
+
+    def _vdisk_addition(self, vdisk):
+        return (CONTROL_DOMAIN, "vdisk "+vdisk["vdisk"],
+                "add_vdisk", (self.name, vdisk["vdisk"], vdisk["vds"]),
+                { "volume": vdisk["volume"], "id": vdisk["id"] })
+
+    def _vnet_addition(self, vnet):
+        return (CONTROL_DOMAIN, "vnet "+vnet["vnet"],
+                "add_vnet", (self.name, vnet["vnet"], vnet["vswitch"]),
+                { "pvid": vnet["pvid"], "id": vnet["id"], "mtu": vnet.get("mtu", 1500) })
+
+    def _add_devices(self, additions, parallel = False):
+        """ Make C{additions}, a list of (service domain, description, method,
+        args, kwargs) tuples, one C{add_*} call each, treating devices that
+        already exist as done.  With C{parallel}, the additions for each
+        service domain are made at the same time, each over a connection
+        taken from the pool. """
+        if self.module.check_mode or len(additions) == 0:
+            return
+        groups = by_service_domain(additions)
+        results = dict()
+        if parallel and len(groups) > 1:
+            def add_group(domain, group):
+                lxc = self.connections.get()
+                try:
+                    results[domain] = self._add_each(lxc, group)
+                except Exception as e:
+                    results[domain] = [ str(e) ]*len(group)
+                finally:
+                    self.connections.put(lxc)
+            # lend this domain's connection to the threads while they run
+            self._put_lxc()
+            run_threads(add_group, groups)
+        else:
+            for domain, group in groups:
+                results[domain] = self._add_each(self.lxc, group)
+        self.invalidate()
+        for addition in additions:
+            error = results[addition[0]].pop(0)
+            if error is None:
+                self.changed = True
+            elif re.search("already exists", error) is None:
+                self.fail(addition[1]+": "+error)
+            else:
+                self.msg.append(error)
+
+    @staticmethod
+    def _add_each(lxc, additions):
+        """ Return the error of each addition, None where it succeeded. """
+        errors = []
+        for domain, desc, method, args, kwargs in additions:
             try:
-                self.vdisks = [
-                    # primary
-                    { "vdisk": "rootdisk0",
-                    "vds": "primary-vds"+self.vds_id,
-                    "volume": self.name+"-rootdisk0",
-                    "id": 0,
-                    "backend": "/dev/dsk/"+devices[self.name+"_OS_01"],
-                    "mpgroup": self.name+"-rootdisk0" },
-                    { "vdisk": "appdisk0",
-                    "vds": "primary-vds"+self.vds_id,
-                    "volume": self.name+"-appdisk0",
-                    "id": 1,
-                    "backend": "/dev/dsk/"+devices[self.name+"_OS_02"],
-                    "mpgroup": self.name+"-appdisk0" },
-                    { "vdisk": "gidisk0",
-                    "vds": "primary-vds"+self.vds_id,
-                    "volume": self.name+"-gidisk0",
-                    "id": 2,
-                    "backend": "/dev/dsk/"+devices[self.name+"_OS_03"],
-                    "mpgroup": self.name+"-gidisk0" },
-                    { "vdisk": "dbdisk0",
-                    "vds": "primary-vds"+self.vds_id,
-                    "volume": self.name+"-dbdisk0",
-                    "id": 3,
-                    "backend": "/dev/dsk/"+devices[self.name+"_OS_04"],
-                    "mpgroup": self.name+"-dbdisk0" },
-                    { "vdisk": self.name+"-cmd0",
+                getattr(lxc, method)(*args, **kwargs)
+            except LDMError as e:
+                errors.append(str(e))
+            else:
+                errors.append(None)
+        return errors
+
+    def _reconcile_vdisks(self, vdisks):
+        """ Compare the wanted vdisks with the vdsdevs and vdisks currently
+        bound and change only what differs.  Vdisks that are not wanted are
+        removed, along with the vdsdevs that no vdisk uses any more. """
+        bindings = self.bindings()
+        cur_vdisks = bindings.get(self.name, {}).get("vdisk", {})
+        wanted_vols = set(vdisk["volume"]+"@"+vdisk["vds"] for vdisk in vdisks)
+        wanted_vdisks = set(vdisk["vdisk"] for vdisk in vdisks
+                            if not re.match(r"^secondary", vdisk["vds"]))
+        rm_vdisks = []
+        rm_vdsdevs = []
+        add_vdsdevs = []
+        add_vdisks = []
+        for vdisk in vdisks:
+            vds = vdisk["vds"]
+            vols = bindings.get(service_domain(vds), {}).get("vds", {}).get(vds, {})
+            cur_vol = vols.get(vdisk["volume"])
+            if cur_vol is None:
+                add_vdsdevs.append(vdisk)
+            elif (cur_vol["dev"] != vdisk["backend"] or
+                  cur_vol["mpgroup"] != vdisk["mpgroup"]):
+                rm_vdsdevs.append(vdisk["volume"]+"@"+vds)
+                add_vdsdevs.append(vdisk)
+            if re.match(r"^secondary", vds):
+                continue
+            cur_vdisk = cur_vdisks.get(vdisk["vdisk"])
+            if cur_vdisk is None:
+                add_vdisks.append(vdisk)
+            elif (cur_vdisk["vol"] != vdisk["volume"]+"@"+vds or
+                  cur_vdisk["id"] != str(vdisk["id"]) or
+                  vdisk["volume"]+"@"+vds in rm_vdsdevs):
+                rm_vdisks.append(vdisk["vdisk"])
+                add_vdisks.append(vdisk)
+        for vdisk_name, cur_vdisk in sorted(cur_vdisks.items()):
+            # a vdsdev can't be removed while a vdisk still uses it
+            if ((vdisk_name not in wanted_vdisks or cur_vdisk["vol"] in rm_vdsdevs) and
+                vdisk_name not in rm_vdisks):
+                rm_vdisks.append(vdisk_name)
+        for vol in self._unused_vdsdevs(bindings, rm_vdisks, wanted_vols):
+            if vol not in rm_vdsdevs:
+                rm_vdsdevs.append(vol)
+
+        self._ldm_changes([ (CONTROL_DOMAIN, "Removed vdisk: "+vdisk_name,
+                             [ "rm-vdisk", vdisk_name, self.name ])
+                            for vdisk_name in rm_vdisks ]+
+                          [ (service_domain(vol.split("@")[1]), "Removed vdsdev: "+vol,
+                             [ "rm-vdsdev", vol ]) for vol in rm_vdsdevs ])
+        self._ldm_changes([ (service_domain(vdisk["vds"]),
+                             "Added vdsdev: "+vdisk["volume"]+"@"+vdisk["vds"],
+                             [ "add-vdsdev", "-f", "mpgroup="+vdisk["mpgroup"],
+                               vdisk["backend"], vdisk["volume"]+"@"+vdisk["vds"] ])
+                            for vdisk in add_vdsdevs ], parallel = True)
+        self._ldm_changes([ (CONTROL_DOMAIN, "Added vdisk: "+vdisk["vdisk"],
+                             [ "add-vdisk", "id="+str(vdisk["id"]), vdisk["vdisk"],
+                               vdisk["volume"]+"@"+vdisk["vds"], self.name ])
+                            for vdisk in add_vdisks ])
+
+    def _unused_vdsdevs(self, bindings, rm_vdisks, keep):
+        """ Return the vdsdevs that the vdisks in C{rm_vdisks} use, and those in
+        the same mpgroup, that no other vdisk of any domain uses and that are
+        not in C{keep}. """
+        mpgroups = dict()
+        used = set()
+        for name, domain in bindings.iteritems():
+            for vds, vols in domain["vds"].iteritems():
+                for vol, props in vols.iteritems():
+                    mpgroups[vol+"@"+vds] = props["mpgroup"]
+            for vdisk_name, vdisk in domain["vdisk"].iteritems():
+                if name != self.name or vdisk_name not in rm_vdisks:
+                    used.add(vdisk["vol"])
+        cur_vdisks = bindings.get(self.name, {}).get("vdisk", {})
+        removed = set(cur_vdisks[vdisk_name]["vol"] for vdisk_name in rm_vdisks
+                      if vdisk_name in cur_vdisks)
+        groups = set(mpgroups[vol] for vol in removed if mpgroups.get(vol))
+        return sorted(vol for vol, group in mpgroups.iteritems()
+                      if (vol in removed or group in groups) and
+                      vol not in used and vol not in keep)
+
+    def _reconcile_vnets(self, vnets):
+        """ Compare the wanted vnets with those currently bound, removing vnets
+        that are not wanted, changing pvid/mtu in place, re-creating vnets on
+        the wrong switch or id and adding only the missing ones. """
+        cur_vnets = self.bindings().get(self.name, {}).get("vnet", {})
+        wanted = set(vnet["vnet"] for vnet in vnets)
+        removals = [ (CONTROL_DOMAIN, "Removed vnet: "+vnet_name,
+                      [ "rm-vnet", vnet_name, self.name ])
+                     for vnet_name in sorted(cur_vnets) if vnet_name not in wanted ]
+        changes = []
+        additions = []
+        for vnet in vnets:
+            mtu = str(vnet.get("mtu", 1500))
+            cur_vnet = cur_vnets.get(vnet["vnet"])
+            if cur_vnet is not None:
+                if (cur_vnet["service"].split("@")[0] != vnet["vswitch"] or
+                    cur_vnet["id"] != str(vnet["id"])):
+                    removals.append((CONTROL_DOMAIN, "Removed vnet: "+vnet["vnet"],
+                                     [ "rm-vnet", vnet["vnet"], self.name ]))
+                    cur_vnet = None
+                elif cur_vnet["pvid"] != str(vnet["pvid"]) or cur_vnet["mtu"] != mtu:
+                    changes.append((CONTROL_DOMAIN, "Changed vnet: "+vnet["vnet"],
+                                    [ "set-vnet", "pvid="+str(vnet["pvid"]),
+                                      "mtu="+mtu, vnet["vnet"], self.name ]))
+            if cur_vnet is None:
+                additions.append((CONTROL_DOMAIN, "Added vnet: "+vnet["vnet"],
+                                  [ "add-vnet", "pvid="+str(vnet["pvid"]),
+                                    "id="+str(vnet["id"]), "mtu="+mtu, vnet["vnet"],
+                                    vnet["vswitch"], self.name ]))
+        self._ldm_changes(removals+changes+additions)
+
+    def bindings(self):
+        """ Return the state, cores, memory, variables, vdisks, vnets and VDS
+        volumes of every domain, as parsed by L{parse_ldm_list}.  All of them
+        are read with one C{ldm list} and kept until L{invalidate} is
+        called. """
+        if self._bindings is None:
+            rc, stdout, stderr = self.module.run_command([ LDM, "list", "-p", "-o",
+                                                           "domain,core,memory,disk,network" ])
+            if rc != 0:
+                self.fail("Unable to list domain bindings: "+
+                          stderr.strip())
+            self._bindings = parse_ldm_list(stdout)
+        return self._bindings
+
+    def _current(self, key):
+        """ Return the domain's current value of C{key} from L{bindings}, or
+        None if the domain does not exist. """
+        domain = self.bindings().get(self.name)
+        if domain is None:
+            return None
+        return domain[key]
+
+    def _ldm_changes(self, changes, parallel = False):
+        """ Make C{changes}, a list of (service domain, description, ldm
+        arguments) tuples, with the ldm command, stopping at the first one
+        that fails.  With C{parallel}, the changes for each service domain
+        are made at the same time. """
+        if len(changes) == 0:
+            return
+        for domain, desc, args in changes:
+            self.msg.append(desc)
+        if self.module.check_mode:
+            return
+        errors = []
+        def run(domain, group):
+            for domain, desc, args in group:
+                rc, stdout, stderr = self.module.run_command([ LDM ]+args)
+                if rc != 0:
+                    errors.append(desc+" failed: "+(stderr or stdout).strip())
+                    return
+        groups = by_service_domain(changes)
+        if parallel:
+            run_threads(run, groups)
+        else:
+            run(None, changes)
+        self.invalidate()
+        self.changed = True
+        if len(errors) != 0:
+            self.fail("; ".join(errors))
+
+    def rac_OS_disks(self):
+        """ Return the vdisks for the domain's OS LDEVs and command device. """
+        devices = LDEVBlock.hds_find([ self.name+"_OS_0"+str(i) for i in range(1, 5) ],
+                                     "device")
+        try:
+            return [
+                # primary
+                { "vdisk": "rootdisk0",
+                "vds": "primary-vds"+self.vds_id,
+                "volume": self.name+"-rootdisk0",
+                "id": 0,
+                "backend": "/dev/dsk/"+devices[self.name+"_OS_01"],
+                "mpgroup": self.name+"-rootdisk0" },
+                { "vdisk": "appdisk0",
+                "vds": "primary-vds"+self.vds_id,
+                "volume": self.name+"-appdisk0",
+                "id": 1,
+                "backend": "/dev/dsk/"+devices[self.name+"_OS_02"],
+                "mpgroup": self.name+"-appdisk0" },
+                { "vdisk": "gidisk0",
+                "vds": "primary-vds"+self.vds_id,
+                "volume": self.name+"-gidisk0",
+                "id": 2,
+                "backend": "/dev/dsk/"+devices[self.name+"_OS_03"],
+                "mpgroup": self.name+"-gidisk0" },
+                { "vdisk": "dbdisk0",
+                "vds": "primary-vds"+self.vds_id,
+                "volume": self.name+"-dbdisk0",
+                "id": 3,
+                "backend": "/dev/dsk/"+devices[self.name+"_OS_04"],
+                "mpgroup": self.name+"-dbdisk0" },
+                { "vdisk": self.name+"-cmd0",
+                "vds": "primary-vds"+self.vds_id,
+                "volume": self.name+"-cmd0",
+                "id": 99,
+                "backend": "/dev/dsk/"+
+                LDEVBlock.get_cmd_device(self.horcminst),
+                "mpgroup": self.name+"-cmd0" },
+                # secondary
+                { "vdisk": "rootdisk0",
+                "vds": "secondary-vds"+self.vds_id,
+                "volume": self.name+"-rootdisk0",
+                "id": 0,
+                "backend": "/dev/dsk/"+devices[self.name+"_OS_01"],
+                "mpgroup": self.name+"-rootdisk0" },
+                { "vdisk": "appdisk0",
+                "vds": "secondary-vds"+self.vds_id,
+                "volume": self.name+"-appdisk0",
+                "id": 1,
+                "backend": "/dev/dsk/"+devices[self.name+"_OS_02"],
+                "mpgroup": self.name+"-appdisk0" },
+                { "vdisk": "gidisk0",
+                "vds": "secondary-vds"+self.vds_id,
+                "volume": self.name+"-gidisk0",
+                "id": 2,
+                "backend": "/dev/dsk/"+devices[self.name+"_OS_03"],
+                "mpgroup": self.name+"-gidisk0" },
+                { "vdisk": "dbdisk0",
+                "vds": "secondary-vds"+self.vds_id,
+                "volume": self.name+"-dbdisk0",
+                "id": 3,
+                "backend": "/dev/dsk/"+devices[self.name+"_OS_04"],
+                "mpgroup": self.name+"-dbdisk0" },
+                { "vdisk": self.name+"cmd0",
+                "vds": "secondary-vds"+self.vds_id,
+                "volume": self.name+"-cmd0",
+                "id": 99,
+                "backend": "/dev/dsk/"+
+                LDEVBlock.get_cmd_device(self.horcminst),
+                "mpgroup": self.name+"-cmd0" }
+            ]
+        except KeyError as e:
+            self.fail("OS LDEV not found: "+str(e))
+
+    def rac_env_disks(self):
+        """ Return the vdisks for the LDEVs of each environment in rac_storage. """
+        vdisks = []
+        vdisk_id = 10
+        for env in self.rac_storage:
+            devices = LDEVBlock.hds_scan(env, "device")
+            for volname in sorted(devices):
+                if not volname.startswith(env):
+                    continue
+                device = devices[volname]
+                # primary
+                vdisks.append( {
+                    "vdisk": volname.lower(),
                     "vds": "primary-vds"+self.vds_id,
-                    "volume": self.name+"-cmd0",
-                    "id": 99,
-                    "backend": "/dev/dsk/"+
-                    LDEVBlock.get_cmd_device(self.horcminst),
-                    "mpgroup": self.name+"-cmd0" },
-                    # secondary
-                    { "vdisk": "rootdisk0",
-                    "vds": "secondary-vds"+self.vds_id,
-                    "volume": self.name+"-rootdisk0",
-                    "id": 0,
-                    "backend": "/dev/dsk/"+devices[self.name+"_OS_01"],
-                    "mpgroup": self.name+"-rootdisk0" },
-                    { "vdisk": "appdisk0",
-                    "vds": "secondary-vds"+self.vds_id,
-                    "volume": self.name+"-appdisk0",
-                    "id": 1,
-                    "backend": "/dev/dsk/"+devices[self.name+"_OS_02"],
-                    "mpgroup": self.name+"-appdisk0" },
-                    { "vdisk": "gidisk0",
-                    "vds": "secondary-vds"+self.vds_id,
-                    "volume": self.name+"-gidisk0",
-                    "id": 2,
-                    "backend": "/dev/dsk/"+devices[self.name+"_OS_03"],
-                    "mpgroup": self.name+"-gidisk0" },
-                    { "vdisk": "dbdisk0",
+                    "volume": volname,
+                    "id": vdisk_id,
+                    "backend": "/dev/dsk/"+device,
+                    "mpgroup": volname+"_"+self.node_id } )
+                # secondary
+                vdisks.append( {
+                    "vdisk": volname.lower(),
                     "vds": "secondary-vds"+self.vds_id,
-                    "volume": self.name+"-dbdisk0",
-                    "id": 3,
-                    "backend": "/dev/dsk/"+devices[self.name+"_OS_04"],
-                    "mpgroup": self.name+"-dbdisk0" },
-                    { "vdisk": self.name+"cmd0",
-                    "vds": "secondary-vds"+self.vds_id,
-                    "volume": self.name+"-cmd0",
-                    "id": 99,
-                    "backend": "/dev/dsk/"+
-                    LDEVBlock.get_cmd_device(self.horcminst),
-                    "mpgroup": self.name+"-cmd0" }
-                ]
-            except KeyError as e:
-                self.module.fail_json(msg="KeyError setting up OS disks")
-            self.set_vdisks()
-
-    def setup_rac_env_disks(self):
-        if not self.module.check_mode:
-            self.vdisks = []
-            vdisk_id = 10
-            for env in self.rac_storage:
-                devices = LDEVBlock.hds_scan(env, "device")
-                for volname in sorted(devices):
-                    if not volname.startswith(env):
-                        continue
-                    device = devices[volname]
-                    # primary
-                    self.vdisks.append( {
-                        "vdisk": volname.lower(),
-                        "vds": "primary-vds"+self.vds_id,
-                        "volume": volname,
-                        "id": vdisk_id,
-                        "backend": "/dev/dsk/"+device,
-                        "mpgroup": volname+"_"+self.node_id } )
-                    # secondary
-                    self.vdisks.append( {
-                        "vdisk": volname.lower(),
-                        "vds": "secondary-vds"+self.vds_id,
-                        "volume": volname,
-                        "id": vdisk_id,
-                        "backend": "/dev/dsk/"+device,
-                        "mpgroup": volname+"_"+self.node_id } )
-                    vdisk_id += 1
-                # set vdisk ID to next multiple of 10 for next env
-                vdisk_id = vdisk_id+(10-vdisk_id%10)
-            self.set_vdisks()
+                    "volume": volname,
+                    "id": vdisk_id,
+                    "backend": "/dev/dsk/"+device,
+                    "mpgroup": volname+"_"+self.node_id } )
+                vdisk_id += 1
+            # set vdisk ID to next multiple of 10 for next env
+            vdisk_id = vdisk_id+(10-vdisk_id%10)
+        return vdisks
 
     def exists(self):
-        try:
-            self.lxc.list(self.name)
-        except:
-            return False
-        return True
+        return self.snapshot() is not None
+
+    def snapshot(self):
+        """ Return the parsed C{list} output for the domain, or None if the
+        domain does not exist.  The result is kept until L{invalidate} is
+        called, so status checks between changes cost no ldmd requests. """
+        if not self._snapshot_valid:
+            if self.reconcile:
+                # everything reconcile needs comes from the one ldm list
+                domain = self.bindings().get(self.name)
+                if domain is None:
+                    self._snapshot = None
+                else:
+                    self._snapshot = { "ldom_info": { "state": domain["state"] } }
+            else:
+                try:
+                    self._snapshot = self.lxc.list(self.name)
+                except:
+                    self._snapshot = None
+            self._snapshot_valid = True
+        return self._snapshot
+
+    def invalidate(self):
+        """ Discard the domain snapshot.  Must be called after any change made
+        through the LDM connection. """
+        self._snapshot_valid = False
+        self._bindings = None
 
     def is_active(self):
         return self.status() == "active"
@@ -481,13 +997,8 @@ class LDOM:
         return self.status() == "inactive"
 
     def status(self):
-        if self.exists():
-            try:
-                ldmcfg = self.lxc.list(self.name)
-            except LDMError as e:
-                self.msg.append()
-                self.module.fail_json(msg = "Unable to get domain status: "+
-                                      str(e))
+        ldmcfg = self.snapshot()
+        if ldmcfg is not None:
             ldom_info = ldmcfg["ldom_info"]
             return ldom_info["state"]
         else:
@@ -500,8 +1011,10 @@ class LDOM:
                     self.lxc.bind(self.name)
                 self.lxc.start(self.name)
             except LDMError as e:
-                self.module.fail_json(msg = "Unable to activate domain: "+
-                                      str(e))
+                self.fail("Unable to activate domain: "+
+                          str(e))
+            finally:
+                self.invalidate()
             self.changed = True
             self.msg.append("Domain active")
 
@@ -513,8 +1026,10 @@ class LDOM:
                 else:
                     self.lxc.bind(self.name)
             except LDMError as e:
-                self.module.fail_json(msg = "Unable to bind domain: "+
-                                      str(e))
+                self.fail("Unable to bind domain: "+
+                          str(e))
+            finally:
+                self.invalidate()
             self.changed = True
             self.msg.append("Domain bound")
 
@@ -525,33 +1040,124 @@ class LDOM:
                     self.lxc.stop(self.name)
                 self.lxc.unbind(self.name)
             except LDMError as e:
-                self.msg.append()
-                self.module.fail_json(msg = "Unable to deactivate domain: "+
-                                      str(e))
+                self.fail("Unable to deactivate domain: "+
+                          str(e))
+            finally:
+                self.invalidate()
             self.changed = True
             self.msg.append("Domain inactive")
 
+def rescan_san(module):
+    """ Run cfgadm on the primary and secondary service domains at the same
+    time, failing with the output of every rescan that failed. """
+    sec_svc = platform.node().replace("pri", "sec")
+    procs = []
+    for host, cmd in [ (platform.node(), [ CFGADM, "-al" ]),
+                       (sec_svc, [ SSH, sec_svc, CFGADM+" -al" ]) ]:
+        procs.append((host, subprocess.Popen(cmd, stdout = subprocess.PIPE,
+                                             stderr = subprocess.STDOUT,
+                                             close_fds = True)))
+    errors = []
+    for host, proc in procs:
+        output = proc.communicate()[0]
+        if proc.returncode != 0:
+            errors.append(host+": "+output.strip())
+    if len(errors) != 0:
+        module.fail_json(msg = "cfgadm command failed: "+"; ".join(errors))
+
+BOOLEANS_TRUE = [ "y", "yes", "on", "1", "true", "t" ]
+BOOLEANS_FALSE = [ "n", "no", "off", "0", "false", "f" ]
+
+def convert_option(value, option_type):
+    """ Convert an option value to C{option_type} the way Ansible converts
+    top-level options, raising TypeError or ValueError if it cannot be. """
+    if option_type == "str":
+        if isinstance(value, (list, dict)):
+            raise TypeError(value)
+        return value if isinstance(value, basestring) else str(value)
+    if option_type == "int":
+        if isinstance(value, bool) or not isinstance(value, (int, long, basestring)):
+            raise TypeError(value)
+        return int(value)
+    if option_type == "bool":
+        if isinstance(value, bool):
+            return value
+        if str(value).lower() in BOOLEANS_TRUE:
+            return True
+        if str(value).lower() in BOOLEANS_FALSE:
+            return False
+        raise ValueError(value)
+    if option_type == "list":
+        if isinstance(value, list):
+            return value
+        if isinstance(value, basestring):
+            return [ item.strip() for item in value.split(",") ]
+        if isinstance(value, (int, long, float)):
+            return [ str(value) ]
+        raise TypeError(value)
+    if option_type == "dict":
+        if isinstance(value, basestring):
+            value = json.loads(value)
+        if not isinstance(value, dict):
+            raise TypeError(value)
+        return value
+    return value
+
+def check_domain(module, argument_spec, domain):
+    """ Check one entry of the domains list against the module's
+    C{argument_spec} and return its options, with those it does not give
+    taken from the top level.  Fails on unknown options, values that cannot
+    be converted to the option's type and values not among its choices. """
+    if not isinstance(domain, dict) or domain.get("name") is None:
+        module.fail_json(msg = "Every entry in domains needs a name")
+    label = "domains entry "+str(domain["name"])
+    unknown = sorted(str(key) for key in domain if key not in DOMAIN_OPTIONS)
+    if len(unknown) != 0:
+        module.fail_json(msg = label+": unsupported option(s) "+
+                         ", ".join(unknown)+"; supported options are "+
+                         ", ".join(DOMAIN_OPTIONS))
+    params = dict((key, module.params[key]) for key in DOMAIN_OPTIONS)
+    for key, value in domain.items():
+        spec = argument_spec[key]
+        if value is not None:
+            try:
+                value = convert_option(value, spec.get("type", "str"))
+            except (TypeError, ValueError):
+                module.fail_json(msg = label+": option "+key+" must be of type "+
+                                 spec.get("type", "str")+", got "+repr(value))
+            if "choices" in spec and value not in spec["choices"]:
+                module.fail_json(msg = label+": option "+key+" must be one of "+
+                                 ", ".join(spec["choices"])+", got "+repr(value))
+        params[key] = value
+    return params
+
 def main():
-    module = AnsibleModule(
-        argument_spec = dict(
-            name = dict(required = True, type = "str"),
-            cpu_arch = dict(default = "migration-class1",
-                          choices = ["generic", "native", "migration-class1",
-                                     "sparc64-class1"], type = "str"),
-            cores = dict(default = None, type = "int"),
-            memory = dict(default = None, type = "int"),
-            domain_vars = dict(default = None, type = "dict"),
-            vdisks = dict(default = None, type = "list"),
-            vnets = dict(default = None, type = "list"),
-            rac_storage = dict(default = None, type = "list"),
-            horcminst = dict(default = None, type = "int"),
-            state = dict(default = "same", choices = ["same", "inactive",
-                                                      "bound", "active",
-                                                      "deleted"],
-                         type = "str")
-        ),
-        supports_check_mode = True
+    argument_spec = dict(
+        name = dict(default = None, type = "str"),
+        domains = dict(default = None, type = "list"),
+        parallel = dict(default = 1, type = "int"),
+        cpu_arch = dict(default = "migration-class1",
+                      choices = ["generic", "native", "migration-class1",
+                                 "sparc64-class1"], type = "str"),
+        cores = dict(default = None, type = "int"),
+        memory = dict(default = None, type = "int"),
+        domain_vars = dict(default = None, type = "dict"),
+        vdisks = dict(default = None, type = "list"),
+        vnets = dict(default = None, type = "list"),
+        rac_storage = dict(default = None, type = "list"),
+        horcminst = dict(default = None, type = "int"),
+        reconcile = dict(default = False, type = "bool"),
+        cmd_device_cache = dict(default = None, type = "str"),
+        inventory_cache = dict(default = LDEVBlock.INVENTORY_CACHE, type = "str"),
+        trace_file = dict(default = None, type = "str"),
+        state = dict(default = "same", choices = ["same", "inactive",
+                                                  "bound", "active",
+                                                  "deleted"],
+                     type = "str")
     )
+    module = AnsibleModule(argument_spec = argument_spec,
+                           supports_check_mode = True)
+    tracing.install(module, "solaris_ldom")
 
     if platform.system() != "SunOS":
         module.fail_json(msg = "This module requires Solaris")
@@ -559,45 +1165,87 @@ def main():
     if float(platform.version()) < 11.3:
         module.fail_json(msg = "This module requires Solaris 11.3 or higher")
 
-    ldom = LDOM(module)
-
-    state = module.params["state"]
-    if state == "deleted":
-        ldom.delete()
-        module.exit_json(changed = ldom.changed, msg = " | ".join(ldom.msg))
-    if not ldom.exists():
-        ldom.create()
-
-    if ldom.cores is not None:
-        ldom.set_cores()
-    if ldom.memory is not None:
-        ldom.set_memory()
-    if ldom.domain_vars is not None:
-        ldom.set_vars()
-    if ldom.vdisks is not None:
-        ldom.set_vdisks()
-    if ldom.vnets is not None:
-        ldom.set_vnets()
-    if ldom.rac_storage is not None:
-        try:
-            # run cfgadm on primary and secondary service domains
-            subprocess.check_call(["/usr/sbin/cfgadm", "-al"])
-            sec_svc = platform.node().replace("pri", "sec")
-            subprocess.check_call(["/usr/bin/ssh", sec_svc,
-                                   "/usr/sbin/cfgadm -al"])
-        except subprocess.CalledProcessError as e:
-            module.fail_json(msg = "cfgadm command failed: "+e.output)
-        ldom.setup_rac_OS_disks()
-        ldom.setup_rac_env_disks()
-
-    if state == "active":
-        ldom.state_active()
-    elif state == "bound":
-        ldom.state_bound()
-    elif state == "inactive":
-        ldom.state_inactive()
-
-    module.exit_json(changed = ldom.changed, msg = " | ".join(ldom.msg))
+    # a single domain is a batch of one, built from the top-level options
+    if module.params["domains"] is None:
+        if module.params["name"] is None:
+            module.fail_json(msg = "One of name or domains is required")
+        domain_params = [ module.params ]
+    else:
+        domain_params = [ check_domain(module, argument_spec, domain)
+                          for domain in module.params["domains"] ]
+
+    LDEVBlock.CMD_DEVICE_CACHE = module.params["cmd_device_cache"]
+    LDEVBlock.INVENTORY_CACHE = module.params["inventory_cache"] or None
+
+    # rescan and build the device inventory once for every domain
+    rac_params = [ p for p in domain_params
+                   if p["rac_storage"] is not None and p["state"] != "deleted" ]
+    for params in rac_params:
+        if params["horcminst"] not in LDEVBlock.SAN_DATA:
+            module.fail_json(msg = params["name"]+": horcminst must be one of "+
+                             ", ".join(str(i) for i in sorted(LDEVBlock.SAN_DATA))+
+                             " with rac_storage")
+    if len(rac_params) != 0:
+        rescan_san(module)
+        if not module.check_mode:
+            # the environment disks need every LDEV, so the host is scanned
+            # once here rather than by whichever worker gets there first
+            LDEVBlock.inventory()
+            for params in rac_params:
+                hex_serial = LDEVBlock.SAN_DATA[params["horcminst"]]["hex_serial"]
+                if LDEVBlock.inventory(scan = False).get_cmd_device(
+                        hex_serial, LDEVBlock.CMD_DEVICE_CACHE) is None:
+                    module.fail_json(msg = "Unable to get command device for serial "+
+                                     hex_serial)
+
+    connections = LDMConnections()
+    ldoms = [ LDOM(module, params, connections) for params in domain_params ]
+    parallel = module.params["parallel"]
+    if parallel > 1 and len(domain_params) > 1:
+        queue = list(ldoms)
+        lock = threading.Lock()
+        def worker():
+            while True:
+                with lock:
+                    if len(queue) == 0:
+                        return
+                    ldom = queue.pop(0)
+                ldom.configure()
+        threads = [ threading.Thread(target = worker)
+                    for i in range(min(parallel, len(ldoms))) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    else:
+        failed = None
+        for ldom in ldoms:
+            if failed is not None:
+                ldom.failure = "Skipped because "+failed.name+" failed"
+                continue
+            ldom.configure()
+            if ldom.failure is not None:
+                failed = ldom
+
+    changed = any(ldom.changed for ldom in ldoms)
+    if module.params["domains"] is None:
+        ldom = ldoms[0]
+        if ldom.failure is not None:
+            module.fail_json(msg = ldom.failure)
+        module.exit_json(changed = changed, msg = " | ".join(ldom.msg))
+
+    results = dict()
+    failures = []
+    for ldom in ldoms:
+        results[ldom.name] = { "changed": ldom.changed, "msg": ldom.msg,
+                               "failed": ldom.failure is not None }
+        if ldom.failure is not None:
+            failures.append(ldom.name+": "+ldom.failure)
+    msg = " | ".join(ldom.name+": "+m for ldom in ldoms for m in ldom.msg)
+    if len(failures) != 0:
+        module.fail_json(msg = " | ".join(failures), changed = changed,
+                         domains = results)
+    module.exit_json(changed = changed, msg = msg, domains = results)
 
 
 from ansible.module_utils.basic import *
@@ -0,0 +1,228 @@
+""" Per-command timing shared by the autobuild modules.
+
+After L{install}, every process the module starts through the subprocess
+module (including C{module.run_command}) and every call on a connection
+wrapped with L{TracedClient} is recorded with its duration, exit status and
+the number of bytes sent to and read from it.  The records are returned as
+C{timings} with the module result:
+
+    "timings": { "seconds": 12.4,
+                 "commands": [ { "kind": "exec", "cmd": "/usr/sbin/ipadm show-if -po IFNAME,STATE",
+                                 "start": 0.012, "seconds": 0.081, "rc": 0,
+                                 "bytes_in": 0, "bytes_out": 96 } ],
+                 "dropped": 0,
+                 "by_tool": { "ipadm": { "count": 1, "seconds": 0.081 } } }
+
+Only the first C{MAX_RECORDS} commands are listed; C{by_tool} covers them
+all.  If a trace file is given, each record is also appended to it as a JSON
+line as soon as the command finishes, so a slow or hung run can be followed
+on the target while it happens. """
+
+import os, time, json, threading, subprocess
+
+MAX_RECORDS = 1000
+_Popen = subprocess.Popen
+
+_lock = threading.Lock()
+_local = threading.local()
+_state = { "start": None, "name": None, "trace_file": None,
+           "records": [], "dropped": 0, "by_tool": {} }
+
+def install(module, name):
+    """ Start timing for C{module}, which is known as C{name} in the trace
+    file.  Wraps subprocess.Popen and the module's run_command, and its
+    exit_json and fail_json so that every result carries the timings. """
+    with _lock:
+        _state["start"] = time.time()
+        _state["name"] = name
+        _state["trace_file"] = module.params.get("trace_file")
+        _state["records"] = []
+        _state["dropped"] = 0
+        _state["by_tool"] = {}
+    subprocess.Popen = TimedPopen
+    for method in ("exit_json", "fail_json"):
+        setattr(module, method, _with_timings(getattr(module, method)))
+    module.run_command = _timed_run_command(module.run_command)
+
+def _with_timings(method):
+    def call(**kwargs):
+        kwargs["timings"] = timings()
+        method(**kwargs)
+    return call
+
+def _timed_run_command(method):
+    # run_command reads its pipes with os.read(), past the byte counting in
+    # TimedPopen, so record the command here from what it returns instead
+    def call(args, **kwargs):
+        start = time.time()
+        _local.quiet = True
+        try:
+            rc, stdout, stderr = method(args, **kwargs)
+        finally:
+            _local.quiet = False
+        record("exec", args, start, rc, len(kwargs.get("data") or ""),
+               len(stdout or "")+len(stderr or ""))
+        return rc, stdout, stderr
+    return call
+
+def timings():
+    """ Return the C{timings} result for everything recorded so far. """
+    with _lock:
+        if _state["start"] is None:
+            seconds = 0
+        else:
+            seconds = round(time.time()-_state["start"], 3)
+        return { "seconds": seconds, "commands": list(_state["records"]),
+                 "dropped": _state["dropped"],
+                 "by_tool": dict((tool, dict(totals))
+                                 for tool, totals in _state["by_tool"].items()) }
+
+def record(kind, cmd, start, rc, bytes_in = 0, bytes_out = 0):
+    """ Record one command that started at time C{start} and has just
+    finished.  C{cmd} is a string or an argument list. """
+    end = time.time()
+    if not isinstance(cmd, basestring):
+        cmd = " ".join(str(arg) for arg in cmd)
+    if _state["start"] is None:
+        return
+    entry = { "kind": kind, "cmd": cmd, "start": round(start-_state["start"], 3),
+              "seconds": round(end-start, 3), "rc": rc,
+              "bytes_in": bytes_in, "bytes_out": bytes_out }
+    tool = os.path.basename(cmd.split()[0]) if cmd.strip() else kind
+    if kind != "exec":
+        tool = kind+" "+tool
+    with _lock:
+        if len(_state["records"]) < MAX_RECORDS:
+            _state["records"].append(entry)
+        else:
+            _state["dropped"] += 1
+        totals = _state["by_tool"].setdefault(tool, { "count": 0, "seconds": 0 })
+        totals["count"] += 1
+        totals["seconds"] = round(totals["seconds"]+entry["seconds"], 3)
+        trace_file = _state["trace_file"]
+        if trace_file is not None:
+            line = dict(entry, module = _state["name"], pid = os.getpid(), time = end)
+            try:
+                fh = open(trace_file, "a")
+                fh.write(json.dumps(line)+"\n")
+                fh.close()
+            except IOError:
+                # tracing must never break the module itself
+                pass
+
+class _CountedPipe(object):
+    """ File object wrapper counting the bytes passed through a pipe. """
+
+    def __init__(self, fh):
+        self._fh = fh
+        self.count = 0
+
+    def read(self, *args):
+        data = self._fh.read(*args)
+        self.count += len(data)
+        return data
+
+    def readline(self, *args):
+        data = self._fh.readline(*args)
+        self.count += len(data)
+        return data
+
+    def __iter__(self):
+        return iter(self.readline, self._fh.read(0))
+
+    def write(self, data):
+        self._fh.write(data)
+        self.count += len(data)
+
+    def __getattr__(self, name):
+        return getattr(self._fh, name)
+
+class TimedPopen(_Popen):
+    """ subprocess.Popen that records the process with L{record} once it has
+    been reaped.  Bytes out are what it wrote to its stdout and stderr pipes. """
+
+    def __init__(self, args, *posargs, **kwargs):
+        self._trace_start = time.time()
+        self._trace_cmd = args
+        self._trace_done = False
+        self._in_communicate = False
+        # started by run_command, which records the command itself
+        self._trace_quiet = getattr(_local, "quiet", False)
+        try:
+            _Popen.__init__(self, args, *posargs, **kwargs)
+        except OSError:
+            record("exec", args, self._trace_start, 127)
+            raise
+        for pipe in ("stdin", "stdout", "stderr"):
+            if getattr(self, pipe) is not None:
+                setattr(self, pipe, _CountedPipe(getattr(self, pipe)))
+
+    def _pipe_count(self, pipe):
+        fh = getattr(self, pipe)
+        return fh.count if isinstance(fh, _CountedPipe) else 0
+
+    def _trace(self, bytes_in = None, bytes_out = None):
+        if self._trace_done or self.returncode is None:
+            return
+        self._trace_done = True
+        if self._trace_quiet:
+            return
+        if bytes_in is None:
+            bytes_in = self._pipe_count("stdin")
+        if bytes_out is None:
+            bytes_out = self._pipe_count("stdout")+self._pipe_count("stderr")
+        record("exec", self._trace_cmd, self._trace_start, self.returncode,
+               bytes_in, bytes_out)
+
+    def communicate(self, input = None):
+        # communicate() may use the pipes directly or through the wrappers, so
+        # count what it is given and returns on top of any earlier traffic
+        bytes_in = self._pipe_count("stdin")+len(input or "")
+        bytes_out = self._pipe_count("stdout")+self._pipe_count("stderr")
+        self._in_communicate = True
+        try:
+            stdout, stderr = _Popen.communicate(self, input)
+        finally:
+            self._in_communicate = False
+        self._trace(bytes_in, bytes_out+len(stdout or "")+len(stderr or ""))
+        return stdout, stderr
+
+    def wait(self, *args, **kwargs):
+        returncode = _Popen.wait(self, *args, **kwargs)
+        if not self._in_communicate:
+            self._trace()
+        return returncode
+
+    def poll(self, *args, **kwargs):
+        returncode = _Popen.poll(self, *args, **kwargs)
+        if not self._in_communicate:
+            self._trace()
+        return returncode
+
+class TracedClient(object):
+    """ Wraps an RPC client such as an C{LDMXMLConnection} so that each method
+    call is recorded as a command of the given C{kind}, named after the method
+    and its string arguments.  An exception counts as exit status 1. """
+
+    def __init__(self, client, kind):
+        self._client = client
+        self._kind = kind
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr):
+            return attr
+        def call(*args, **kwargs):
+            start = time.time()
+            strings = [ arg for arg in args if isinstance(arg, basestring) ]
+            # long arguments are counted, not logged
+            desc = [ name ]+[ s for s in strings if len(s) <= 64 ]
+            try:
+                result = attr(*args, **kwargs)
+            except Exception:
+                record(self._kind, desc, start, 1, sum(len(s) for s in strings))
+                raise
+            bytes_out = len(result) if isinstance(result, basestring) else 0
+            record(self._kind, desc, start, 0, sum(len(s) for s in strings), bytes_out)
+            return result
+        return call
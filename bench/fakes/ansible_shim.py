@@ -0,0 +1,43 @@
+""" Just enough of ansible.module_utils.basic to run the modules in-process.
+The harness sets L{ARGS} and L{CHECK_MODE} before calling a module's main();
+exit_json and fail_json raise L{ModuleExit} carrying the result. """
+import shlex, shutil, subprocess, time
+
+ARGS = {}
+CHECK_MODE = False
+
+class ModuleExit(BaseException):
+    def __init__(self, result):
+        BaseException.__init__(self, result.get("msg"))
+        self.result = result
+
+class AnsibleModule(object):
+    def __init__(self, argument_spec, supports_check_mode = False, **kwargs):
+        self.params = dict()
+        for key, spec in argument_spec.items():
+            self.params[key] = ARGS.get(key, spec.get("default"))
+        self.check_mode = CHECK_MODE and supports_check_mode
+
+    def exit_json(self, **kwargs):
+        kwargs.setdefault("changed", False)
+        raise ModuleExit(kwargs)
+
+    def fail_json(self, **kwargs):
+        kwargs["failed"] = True
+        raise ModuleExit(kwargs)
+
+    def run_command(self, args, check_rc = False):
+        if not isinstance(args, list):
+            args = shlex.split(args)
+        proc = subprocess.Popen(args, stdout = subprocess.PIPE,
+                                stderr = subprocess.PIPE)
+        out, err = proc.communicate()
+        if check_rc and proc.returncode != 0:
+            self.fail_json(cmd = args, rc = proc.returncode, stdout = out,
+                           stderr = err, msg = err.strip())
+        return proc.returncode, out, err
+
+    def backup_local(self, fn):
+        backup = fn+"."+time.strftime("%Y-%m-%d@%H:%M:%S~")
+        shutil.copy2(fn, backup)
+        return backup
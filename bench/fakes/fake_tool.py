@@ -0,0 +1,247 @@
+""" Stand-in for the Solaris and HORCM commands the modules run.  The harness
+installs one wrapper per command name that execs this script with the name as
+its first argument.
+
+Every invocation is appended to $BENCH_LOG as one JSON line and delayed by
+$BENCH_LATENCY_<TOOL> (or $BENCH_LATENCY) seconds.  $BENCH_STATE selects
+whether the host looks freshly installed ("fresh") or already configured
+("steady"). """
+import os, sys, json, time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import san, ldmxml
+
+STEADY = os.environ.get("BENCH_STATE") == "steady"
+VTOC_HEADER = """* /dev/rdsk/c1d10s2 partition map
+*
+* Dimensions:
+*     512 bytes/sector
+*      64 sectors/track
+*      10 tracks/cylinder
+*     640 sectors/cylinder
+*   32766 cylinders
+*   32764 accessible cylinders
+*
+*                          First     Sector    Last
+* Partition  Tag  Flags    Sector     Count    Sector  Mount Directory
+"""
+
+def log(tool, args):
+    path = os.environ.get("BENCH_LOG")
+    if path is None:
+        return
+    line = json.dumps({ "tool": tool, "args": args, "time": time.time() })+"\n"
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line.encode("utf-8"))
+    finally:
+        os.close(fd)
+
+def latency(tool):
+    return float(os.environ.get("BENCH_LATENCY_"+tool.upper(),
+                                os.environ.get("BENCH_LATENCY", "0")))
+
+def raidcom(args):
+    if args[:2] == [ "get", "ldev" ]:
+        begin = args[args.index("-ldev_id")+1].replace(":", "")
+        count = int(args[args.index("-cnt")+1])
+        names = san.ldev_names(san.scale())
+        out = []
+        for ldev in range(int(begin, 16), int(begin, 16)+count):
+            out.append("Serial#  : "+san.SERIAL)
+            out.append("LDEV : "+str(ldev))
+            if STEADY:
+                index = ldev-(san.FIRST_CU << 8)
+                name = names[index] if 0 <= index < len(names) else "BENCH"
+                out.append("VOL_TYPE : OPEN-V-CVS")
+                out.append("LDEV_NAMING : "+name)
+                out.append("VOL_Capacity(BLK) : 104857600")
+                out.append("B_POOLID : 36")
+                out.append("PORTs : CL1-B-0 1 todd-pri : CL2-B-0 1 todd-pri")
+            else:
+                out.append("VOL_TYPE : NOT DEFINED")
+        return 0, "\n".join(out)
+    if args[:2] == [ "get", "command_status" ]:
+        return 0, ("HANDLE   SSB1    SSB2    ERR_CNT        Serial#     Description\n"
+                   "00c3        -       -          0          "+san.SERIAL+"     -")
+    return 0, ""
+
+def inqraid(args):
+    nodes = [ line.strip() for line in sys.stdin if line.strip() ]
+    names = san.ldev_names(san.scale())
+    out = []
+    if "-CM" in args:
+        out.append("DEVICE_FILE                 PORT   SERIAL  LDEV CTG H/M/12 SSID R:Group PRODUCT_ID")
+        for node in nodes:
+            index = san.node_index(node)
+            if index is not None and index == len(names):
+                out.append(node+"  CL1-B  "+san.HEX_SERIAL+"  CM")
+                break
+        return 0, "\n".join(out)
+    out.append("DEVICE_FILE PORT SERIAL LDEV CTG H/M/12 SSID R:Group PRODUCT_ID")
+    for node in nodes:
+        index = san.node_index(node)
+        base = os.path.basename(node)
+        if index is not None and index < len(names):
+            out.append(" ".join([ base, "CL1-B", san.SERIAL, san.ldev_id(index),
+                                  "-", "-", "-", "-", names[index] ]))
+        else:
+            out.append(base+" -")
+    return 0, "\n".join(out)
+
+def dladm(args):
+    if "show-linkprop" in args:
+        links = [ "net0" ]+([ "publink0", "publink1", "privlink0", "privlink1" ]
+                            if STEADY else [ "net1", "net2", "net3", "net4" ])
+        return 0, "\n".join(link+":up" for link in links)
+    return 0, ""
+
+def ipadm(args):
+    if "show-if" in args:
+        ifs = [ "lo0", "net0" ]
+        if STEADY:
+            ifs += [ "publink0", "publink1", "privlink0", "privlink1", "pubnet0", "privnet0" ]
+        return 0, "\n".join(i+":ok" for i in ifs)
+    if "show-addr" in args:
+        if args[-1] in ("pubnet0", "privnet0"):
+            return 0, "ok"
+        addrs = [ "lo0/v4:127.0.0.1/8", "net0/v4:130.164.28.50/24" ]
+        if STEADY:
+            addrs += [ "pubnet0/v4:130.164.13.50/24", "privnet0/v4:192.168.1.50/24" ]
+        return 0, "\n".join(addrs)
+    return 0, ""
+
+def route(args):
+    if "show" in args:
+        gateway = "130.164.13.1" if STEADY else "130.164.28.1"
+        return 0, "persistent: route add default "+gateway
+    return 0, ""
+
+def svcprop(args):
+    probing = "true" if STEADY else "false"
+    nodename = "bench1" if STEADY else "unknown"
+    return 0, ("svc:/network/ipmp:default/:properties/config/transitive-probing boolean "+probing+"\n"
+               "svc:/system/identity:node/:properties/config/nodename astring "+nodename)
+
+def ipmpstat(args):
+    return 0, "pubnet0:ok:publink0 publink1\nprivnet0:ok:privlink0 privlink1"
+
+def svccfg(args):
+    if "listprop" in args:
+        if not STEADY:
+            return 1, "svccfg: Instance not found."
+        return 0, "general                    framework\ngeneral/enabled            boolean  false"
+    return 0, ""
+
+def svcs(args):
+    return 0, "online"
+
+def prtvtoc(args):
+    if STEADY:
+        parts = ("       0      2    00        640  20968320  20968959\n"
+                 "       2      5    01          0  20969472  20969471")
+    else:
+        parts = ("       0      2    00          0   2097152   2097151\n"
+                 "       1      3    01    2097152   2097152   4194303\n"
+                 "       2      5    01          0  20969472  20969471")
+    return 0, VTOC_HEADER+parts
+
+def fmthard(args):
+    sys.stdin.read()
+    return 0, ""
+
+def ldm_list(state, domains):
+    """ Print C{ldm list -p -o domain,core,memory,disk,network} for
+    C{domains}, or for the service domains and every guest when none are
+    named. """
+    if not domains:
+        domains = [ "primary", "secondary" ]+sorted(state["domain"])
+    out = [ "VERSION 1.16" ]
+    for domain in domains:
+        props = state["domain"].get(domain, { "state": "active", "cores": 0, "memory": 0,
+                                              "variables": {} })
+        out.append("DOMAIN|name="+domain+"|state="+props["state"]+"|")
+        out.append("CORE")
+        for cid in range(props["cores"]):
+            out.append("|cid="+str(cid)+"|cpuset="+str(cid*8))
+        out.append("MEMORY")
+        if props["memory"]:
+            out.append("|ra=0x10000000|pa=0x10000000|size="+str(props["memory"]))
+        out.append("VARIABLES")
+        for varname, value in sorted(props["variables"].items()):
+            out.append("|"+varname+"="+value)
+        for vds in sorted(state["vds"]):
+            if vds.split("-", 1)[0] != domain:
+                continue
+            out.append("VDS|name="+vds+"|nclients=1")
+            for vol, vol_props in sorted(state["vds"][vds].items()):
+                out.append("|vol="+vol+"|opts=shared|dev="+vol_props["dev"]+
+                           "|mpgroup="+vol_props["mpgroup"])
+        for vdisk, vdisk_props in sorted(state["vdisk"].get(domain, {}).items()):
+            out.append("VDISK|name="+vdisk+"|vol="+vdisk_props["vol"]+"|id="+vdisk_props["id"])
+        for vnet, vnet_props in sorted(state["vnet"].get(domain, {}).items()):
+            out.append("VNET|name="+vnet+"|service="+vnet_props["service"]+"|pvid="+
+                       vnet_props["pvid"]+"|mtu="+vnet_props["mtu"]+"|id="+vnet_props["id"])
+    return "\n".join(out)
+
+def ldm(args):
+    if args[:1] == [ "list" ]:
+        output_fields = args[args.index("-o")+1] if "-o" in args else None
+        domains = [ a for a in args[1:] if not a.startswith("-") and a != output_fields ]
+        with ldmxml.bindings() as state:
+            return 0, ldm_list(state, domains)
+    options = dict(a.split("=", 1) for a in args[1:] if "=" in a)
+    names = [ a for a in args[1:] if "=" not in a and not a.startswith("-") ]
+    with ldmxml.bindings(write = True) as state:
+        try:
+            if args[0] == "add-vdsdev":
+                vol, vds = names[1].split("@")
+                ldmxml.add_vdsdev(state, vds, vol, names[0], options.get("mpgroup"))
+            elif args[0] == "add-vdisk":
+                ldmxml.add_vdisk(state, names[2], names[0], names[1], options.get("id"))
+            elif args[0] == "add-vnet":
+                ldmxml.add_vnet(state, names[2], names[0], names[1], options.get("pvid"),
+                                options.get("id"), options.get("mtu"))
+        except ldmxml.LDMError as e:
+            return 1, str(e)
+        if args[0] == "rm-vdsdev":
+            vol, vds = args[1].split("@")
+            if state["vds"].get(vds, {}).pop(vol, None) is None:
+                return 1, "Volume "+args[1]+" not found"
+        elif args[0] in ("rm-vdisk", "rm-vnet", "set-vnet"):
+            kind = args[0].split("-")[1]
+            name, domain = args[-2:]
+            devices = state[kind].get(domain, {})
+            if name not in devices:
+                return 1, name+" not found in "+domain
+            if args[0] == "set-vnet":
+                devices[name].update(options)
+            else:
+                del devices[name]
+    return 0, ""
+
+def pkg(args):
+    return 0, ("solaris\ttrue\tfalse\ttrue\torigin\tonline\thttp://pkg.example/solaris/\t-\n"
+               "site\ttrue\tfalse\ttrue\torigin\tonline\thttp://pkg.example/site/\t-")
+
+def succeed(args):
+    return 0, ""
+
+TOOLS = { "raidcom": raidcom, "inqraid": inqraid, "dladm": dladm, "ipadm": ipadm,
+          "route": route, "svcprop": svcprop, "ipmpstat": ipmpstat, "svccfg": svccfg,
+          "svcs": svcs, "prtvtoc": prtvtoc, "fmthard": fmthard, "ldm": ldm, "pkg": pkg,
+          "svcadm": succeed, "ping": succeed, "format": succeed, "cfgadm": succeed,
+          "ssh": succeed }
+
+def main():
+    tool = sys.argv[1]
+    args = sys.argv[2:]
+    log(tool, args)
+    time.sleep(latency(tool))
+    rc, output = TOOLS[tool](args)
+    if output:
+        sys.stdout.write(output+"\n")
+    sys.exit(rc)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+""" Stand-in for agent.lib.ldoms.ldmxml.  Each call is counted and delayed by
+$BENCH_LATENCY_LDMD (or $BENCH_LATENCY) seconds.
+
+The domains, vdsdevs, vdisks and vnets are kept in the file named by
+$BENCH_LDM_STATE, so every connection sees the same "ldmd", and the fake ldm
+command reads it for C{ldm list -p} and changes it for C{add-*}, C{rm-*} and
+C{set-vnet}. """
+import os, json, time, fcntl, tempfile, threading, contextlib
+
+@contextlib.contextmanager
+def bindings(write = False):
+    """ Lock the binding state and yield it, in the layout returned by
+    solaris_ldom's parse_ldm_list:
+
+    { "domain": { domain: { "state", "cores", "memory", "variables" } },
+      "vds": { vds: { volume: { "dev", "mpgroup" } } },
+      "vdisk": { domain: { vdisk: { "vol", "id" } } },
+      "vnet": { domain: { vnet: { "service", "pvid", "mtu", "id" } } } }
+
+    With C{write}, the state is saved again when the block ends without an
+    exception. """
+    path = os.environ["BENCH_LDM_STATE"]
+    lock = open(path+".lock", "a")
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    try:
+        try:
+            fh = open(path)
+            state = json.load(fh)
+            fh.close()
+        except (IOError, ValueError):
+            state = { "domain": {}, "vds": {}, "vdisk": {}, "vnet": {} }
+        yield state
+        if write:
+            fd, tmpname = tempfile.mkstemp(dir = os.path.dirname(path))
+            fh = os.fdopen(fd, "w")
+            json.dump(state, fh)
+            fh.close()
+            os.rename(tmpname, path)
+    finally:
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        lock.close()
+
+class LDMError(Exception):
+    pass
+
+class LDMXMLConnection(object):
+    calls = {}
+    connections = 0
+    _lock = threading.Lock()
+
+    def __init__(self):
+        with LDMXMLConnection._lock:
+            LDMXMLConnection.connections += 1
+
+    @classmethod
+    def reset_counters(cls):
+        with cls._lock:
+            cls.calls = {}
+            cls.connections = 0
+
+    def _rpc(self, method):
+        with LDMXMLConnection._lock:
+            LDMXMLConnection.calls[method] = LDMXMLConnection.calls.get(method, 0)+1
+        time.sleep(float(os.environ.get("BENCH_LATENCY_LDMD",
+                                        os.environ.get("BENCH_LATENCY", "0"))))
+
+    @staticmethod
+    def _domain(state, name):
+        if name not in state["domain"]:
+            raise LDMError("Domain "+name+" not found")
+        return state["domain"][name]
+
+    def _update(self, method, name, **props):
+        self._rpc(method)
+        with bindings(write = True) as state:
+            self._domain(state, name).update(props)
+
+    def list(self, name):
+        self._rpc("list")
+        with bindings() as state:
+            return { "ldom_info": { "state": self._domain(state, name)["state"] } }
+
+    def create(self, name, cpu_arch = None):
+        self._rpc("create")
+        with bindings(write = True) as state:
+            if name in state["domain"]:
+                raise LDMError("Domain "+name+" already exists")
+            state["domain"][name] = { "state": "inactive", "cores": 0, "memory": 0,
+                                      "variables": {} }
+
+    def destroy(self, name):
+        self._rpc("destroy")
+        with bindings(write = True) as state:
+            self._domain(state, name)
+            del state["domain"][name]
+
+    def set_core(self, name, cores):
+        self._update("set_core", name, cores = cores)
+
+    def set_memory(self, name, memory):
+        self._update("set_memory", name, memory = memory)
+
+    def update_variables(self, name, variables):
+        self._rpc("update_variables")
+        with bindings(write = True) as state:
+            current = self._domain(state, name)["variables"]
+            for varname, value in variables.items():
+                if value is None:
+                    current.pop(varname, None)
+                else:
+                    current[varname] = str(value)
+
+    def bind(self, name):
+        self._update("bind", name, state = "bound")
+
+    def unbind(self, name):
+        self._update("unbind", name, state = "inactive")
+
+    def start(self, name):
+        self._update("start", name, state = "active")
+
+    def stop(self, name):
+        self._update("stop", name, state = "bound")
+
+    def add_vdsdev(self, vds, volume, backend, mpgroup = None, shared = False):
+        self._rpc("add_vdsdev")
+        with bindings(write = True) as state:
+            add_vdsdev(state, vds, volume, backend, mpgroup)
+
+    def add_vdisk(self, domain, vdisk, vds, volume = None, id = None):
+        self._rpc("add_vdisk")
+        with bindings(write = True) as state:
+            add_vdisk(state, domain, vdisk, str(volume)+"@"+vds, id)
+
+    def add_vnet(self, domain, vnet, vswitch, pvid = None, id = None, mtu = None):
+        self._rpc("add_vnet")
+        with bindings(write = True) as state:
+            add_vnet(state, domain, vnet, vswitch, pvid, id, mtu)
+
+def add_vdsdev(state, vds, volume, backend, mpgroup = None):
+    """ Add a vdsdev to C{state}, for the stub and for the fake ldm. """
+    vols = state["vds"].setdefault(vds, {})
+    if volume in vols:
+        raise LDMError("Volume "+volume+" already exists")
+    vols[volume] = { "dev": backend, "mpgroup": mpgroup or "" }
+
+def add_vdisk(state, domain, vdisk, vol, id = None):
+    vdisks = state["vdisk"].setdefault(domain, {})
+    if vdisk in vdisks:
+        raise LDMError("Disk "+vdisk+" already exists")
+    vdisks[vdisk] = { "vol": vol, "id": "" if id is None else str(id) }
+
+def add_vnet(state, domain, vnet, vswitch, pvid = None, id = None, mtu = None):
+    vnets = state["vnet"].setdefault(domain, {})
+    if vnet in vnets:
+        raise LDMError("Network "+vnet+" already exists")
+    vnets[vnet] = { "service": vswitch+"@"+vswitch.split("-", 1)[0],
+                    "pvid": "" if pvid is None else str(pvid),
+                    "mtu": "1500" if mtu is None else str(mtu),
+                    "id": "" if id is None else str(id) }
@@ -0,0 +1,45 @@
+""" Layout of the simulated storage frame, shared by the fake inqraid and
+raidcom and by the harness that builds the device directory. """
+import os
+
+SERIAL = "93133"
+HEX_SERIAL = "16BCD"
+ENV_GROUP = "BENCH_ENV_DATA"
+FIRST_CU = 0x10
+
+def scale():
+    return { "ldevs": int(os.environ.get("BENCH_LDEVS", "256")),
+             "rdsk": int(os.environ.get("BENCH_RDSK", "2000")),
+             "domains": int(os.environ.get("BENCH_DOMAINS", "20")),
+             "env_ldevs": int(os.environ.get("BENCH_ENV_LDEVS", "16")) }
+
+def domain_name(index):
+    return "bench"+str(index)
+
+def ldev_names(scale):
+    """ Names of the LDEVs on the frame, in device order: four OS disks per
+    domain, the shared environment group, then unrelated LDEVs. """
+    names = []
+    for index in range(1, scale["domains"]+1):
+        names.extend("%s_OS_%02d" % (domain_name(index), n) for n in range(1, 5))
+    names.extend("%s_%02d" % (ENV_GROUP, n) for n in range(1, scale["env_ldevs"]+1))
+    filler = 0
+    while len(names) < scale["ldevs"]:
+        filler += 1
+        names.append("FILLER_%04d" % filler)
+    return names
+
+def ldev_id(index):
+    """ CU:LDEV id of the index'th LDEV, as four hex digits. """
+    return "%04X" % ((FIRST_CU << 8)+index)
+
+def node_name(index):
+    return "c0t%05dd0s2" % index
+
+def node_index(node):
+    """ Inverse of L{node_name}, or None for nodes the harness did not make. """
+    base = os.path.basename(node)
+    try:
+        return int(base[3:8])
+    except ValueError:
+        return None
@@ -0,0 +1,366 @@
+#!/usr/bin/python
+""" Off-box benchmark for the autobuild modules.
+
+Runs ldevblock, solaris_ldom, rac_net, grid_disk and horcm_setup in-process
+against local stand-ins for raidcom, inqraid, ldm/ldmd and the Solaris network,
+disk and SMF tools (see C{fakes/}), first against a freshly installed host and
+then again against the configured result, and finally reconciles domains whose
+bindings have drifted and checks that they have settled.  For every scenario it
+reports wall time, the number of fake commands run, processes spawned and ldmd
+calls made.  A run against an already configured host must report no changes,
+or the benchmark fails.
+
+The command counts do not depend on the speed of the machine, so they are
+compared against C{thresholds.json} and the run fails if any of them grew:
+
+    python bench/run.py
+    python bench/run.py --latency 0.05 --json results.json
+    python bench/run.py --write-thresholds
+
+Runs under the same Python 2 interpreter as the modules. """
+
+import os, sys, json, time, shutil, tempfile, platform, subprocess, threading
+import optparse
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+FAKES_DIR = os.path.join(BENCH_DIR, "fakes")
+MODULES_DIR = os.path.join(os.path.dirname(BENCH_DIR), "ansible_modules")
+THRESHOLDS_FILE = os.path.join(BENCH_DIR, "thresholds.json")
+MODULES = [ "ldevblock", "solaris_ldom", "rac_net", "grid_disk", "horcm_setup" ]
+COUNTERS = [ "commands", "spawns", "rpcs", "connections" ]
+
+sys.path.insert(0, FAKES_DIR)
+sys.path.insert(0, MODULES_DIR)
+import ansible_shim, ldmxml, san
+from fake_tool import TOOLS
+
+class Sandbox:
+    """ Temporary root holding the fake tool wrappers, the simulated
+    /dev/rdsk trees, caches and config files for one benchmark run. """
+
+    def __init__(self, scale, latency):
+        self.root = tempfile.mkdtemp(prefix = "autobuild-bench.")
+        self.bin = self._mkdir("bin")
+        self.rdsk = self._mkdir("rdsk")
+        self.grid_rdsk = self._mkdir("grid_rdsk")
+        self.etc = self._mkdir("etc")
+        self.log = os.path.join(self.root, "commands.log")
+        self.inventory_cache = os.path.join(self.root, "hds_inventory.json")
+        self.ldm_state = os.path.join(self.root, "ldm_state.json")
+
+        fake_tool = os.path.join(FAKES_DIR, "fake_tool.py")
+        for tool in TOOLS:
+            path = os.path.join(self.bin, tool)
+            fh = open(path, "w")
+            fh.write('#!/bin/sh\nexec "'+sys.executable+'" -S "'+fake_tool+'" '+
+                     tool+' "$@"\n')
+            fh.close()
+            os.chmod(path, 0755)
+        for index in range(scale["rdsk"]):
+            open(os.path.join(self.rdsk, san.node_name(index)), "w").close()
+        for index in range(10, 10+scale["grid_disks"]):
+            for slice in ("s0", "s2"):
+                path = os.path.join(self.grid_rdsk, "c1d"+str(index)+slice)
+                open(path, "w").close()
+                os.chmod(path, 0644)
+
+        os.environ["BENCH_LOG"] = self.log
+        os.environ["BENCH_LDM_STATE"] = self.ldm_state
+        os.environ["BENCH_LATENCY"] = str(latency)
+        for key in ("ldevs", "rdsk", "domains", "env_ldevs"):
+            os.environ["BENCH_"+key.upper()] = str(scale[key])
+
+    def _mkdir(self, name):
+        path = os.path.join(self.root, name)
+        os.mkdir(path)
+        return path
+
+    def commands(self, offset):
+        """ Return the fake commands logged since C{offset}, by tool. """
+        counts = dict()
+        if not os.path.exists(self.log):
+            return counts
+        fh = open(self.log)
+        fh.seek(offset)
+        for line in fh:
+            tool = json.loads(line)["tool"]
+            counts[tool] = counts.get(tool, 0)+1
+        fh.close()
+        return counts
+
+    def log_size(self):
+        if not os.path.exists(self.log):
+            return 0
+        return os.path.getsize(self.log)
+
+    def remove(self):
+        shutil.rmtree(self.root, ignore_errors = True)
+
+class SpawnCounter:
+    """ Counts the processes started through subprocess.Popen that are not
+    fake tools.  The fake tools log every invocation however they were
+    started, so those are counted from the command log instead. """
+    count = 0
+    lock = threading.Lock()
+
+    @classmethod
+    def install(cls, bin_dir):
+        popen = subprocess.Popen
+        class CountingPopen(popen):
+            def __init__(self, args, *posargs, **kwargs):
+                cmd = args if isinstance(args, basestring) else args[0]
+                if not cmd.startswith(bin_dir+"/"):
+                    with cls.lock:
+                        cls.count += 1
+                popen.__init__(self, args, *posargs, **kwargs)
+        subprocess.Popen = CountingPopen
+
+def install_shims():
+    """ Make the modules importable off-box: the Ansible module API, the ldmd
+    XML client and a Solaris platform. """
+    for name in ("ansible", "ansible.module_utils", "agent", "agent.lib",
+                 "agent.lib.ldoms"):
+        sys.modules.setdefault(name, type(sys)(name))
+    sys.modules["ansible.module_utils.basic"] = ansible_shim
+    sys.modules["agent.lib.ldoms.ldmxml"] = ldmxml
+    platform.system = lambda: "SunOS"
+    platform.version = lambda: "11.3"
+
+def load_modules(sandbox):
+    """ Import fresh copies of the modules, so that no class level cache
+    survives from the previous scenario, and point every tool path at the
+    fake wrappers. """
+    for name in MODULES:
+        sys.modules.pop(name, None)
+    modules = dict((name, __import__(name)) for name in MODULES)
+    for module in modules.values():
+        namespaces = [ module ]+[ value for value in vars(module).values()
+                                  if type(value).__name__ == "classobj" and
+                                  value.__module__ == module.__name__ ]
+        for namespace in namespaces:
+            for attr, value in vars(namespace).items():
+                if (attr.isupper() and isinstance(value, str) and
+                    value.startswith("/") and os.path.basename(value) in TOOLS):
+                    setattr(namespace, attr, os.path.join(sandbox.bin,
+                                                          os.path.basename(value)))
+    ldevblock = modules["ldevblock"]
+    ldevblock.HDSInventory.RDSK_DIR = sandbox.rdsk
+    ldevblock.LDEVBlock.INVENTORY_CACHE = sandbox.inventory_cache
+    grid_disk = modules["grid_disk"]
+    grid_disk.RDSK_DIR = sandbox.grid_rdsk
+    grid_disk.pwd = FakeAccounts()
+    grid_disk.grp = FakeAccounts()
+    modules["horcm_setup"].HORCM_CONF_DIR = sandbox.etc
+    return modules
+
+class FakeAccounts:
+    """ Resolves the grid user and dba group to whoever runs the benchmark. """
+    class Entry:
+        pw_uid = os.getuid()
+        gr_gid = os.getgid()
+
+    def getpwnam(self, name):
+        return self.Entry()
+
+    def getgrnam(self, name):
+        return self.Entry()
+
+def ldev_blocks(scale):
+    """ ldevblock C{blocks} covering every LDEV on the simulated frame, 16 to
+    a block as the storage playbook defines them. """
+    blocks = []
+    for first in range(0, scale["ldevs"], 16):
+        last = min(first+16, scale["ldevs"])-1
+        begin = san.ldev_id(first)
+        end = san.ldev_id(last)
+        blocks.append({ "name": "BENCH_BLOCK_%03d" % (first/16), "begin": begin[:2]+":"+begin[2:],
+                        "end": end[:2]+":"+end[2:], "size": "50", "ports": [ "CL1-B", "CL2-B" ],
+                        "pool": 36, "chassis": [ "todd" ] })
+    return blocks
+
+def drift_bindings():
+    """ Put the bindings left by the steady run out of step with the playbook,
+    as hand changes on a built chassis would: every appdisk0 vdsdev points at
+    the wrong device, net3 has the wrong pvid, net4 is missing and an extra
+    net9 has been added. """
+    with ldmxml.bindings(write = True) as state:
+        for vols in state["vds"].values():
+            for vol, props in vols.items():
+                if vol.endswith("-appdisk0"):
+                    props["dev"] = "/dev/dsk/c0t0d0s2"
+        for vnets in state["vnet"].values():
+            if "net3" in vnets:
+                vnets["net3"]["pvid"] = "2"
+            vnets.pop("net4", None)
+            vnets["net9"] = { "service": "primary-vsw9@primary", "pvid": "1",
+                              "mtu": "1500", "id": "9" }
+
+def scenarios(scale):
+    domains = [ { "name": san.domain_name(index) } for index in range(1, scale["domains"]+1) ]
+    vnets = [ { "vnet": "net"+str(n), "vswitch": "primary-vsw"+str(n), "pvid": 1, "id": n }
+              for n in range(5) ]
+    ldevblock = { "horcm": "6", "blocks": ldev_blocks(scale), "async_create": True }
+    solaris_ldom = { "domains": domains, "parallel": 4, "cores": 2, "memory": 16,
+                     "vnets": vnets, "rac_storage": [ san.ENV_GROUP ], "horcminst": 6,
+                     "state": "bound" }
+    rac_net = { "pub_ip": "130.164.13.50", "priv_ip": "192.168.1.50", "wait_timeout": 10,
+                "subnets": [ { "network": "130.164.13.0/24", "gateway": "130.164.13.1" } ] }
+    horcm_setup = { "horcminst": 6, "disk_groups": [ san.ENV_GROUP ] }
+    result = []
+    for state in ("fresh", "steady"):
+        result.extend([
+            { "name": "ldevblock_"+state, "module": "ldevblock", "state": state,
+              "node": "bench1-mgmt", "args": ldevblock },
+            # a built chassis is run again with reconcile, as chassis.yml does
+            { "name": "solaris_ldom_"+state, "module": "solaris_ldom", "state": state,
+              "node": "todd-pri", "args": dict(solaris_ldom, reconcile = state == "steady") },
+            { "name": "rac_net_"+state, "module": "rac_net", "state": state,
+              "node": "bench1-mgmt", "args": rac_net },
+            { "name": "grid_disk_"+state, "module": "grid_disk", "state": state,
+              "node": "bench1", "args": {} },
+            { "name": "horcm_setup_"+state, "module": "horcm_setup", "state": state,
+              "node": "bench1", "args": horcm_setup } ])
+    result.extend([
+        { "name": "solaris_ldom_drift", "module": "solaris_ldom", "state": "steady",
+          "node": "todd-pri", "setup": drift_bindings,
+          "args": dict(solaris_ldom, reconcile = True) },
+        { "name": "solaris_ldom_settled", "module": "solaris_ldom", "state": "steady",
+          "node": "todd-pri", "args": dict(solaris_ldom, reconcile = True) } ])
+    return result
+
+def run_scenario(sandbox, scenario):
+    os.environ["BENCH_STATE"] = scenario["state"]
+    if "setup" in scenario:
+        scenario["setup"]()
+    platform.node = lambda: scenario["node"]
+    modules = load_modules(sandbox)
+    ansible_shim.ARGS = scenario["args"]
+    ansible_shim.CHECK_MODE = False
+    ldmxml.LDMXMLConnection.reset_counters()
+    SpawnCounter.count = 0
+    offset = sandbox.log_size()
+
+    start = time.time()
+    try:
+        modules[scenario["module"]].main()
+        result = { "failed": True, "msg": "module returned without exit_json" }
+    except ansible_shim.ModuleExit as e:
+        result = e.result
+    elapsed = time.time()-start
+
+    commands = sandbox.commands(offset)
+    return { "name": scenario["name"], "seconds": round(elapsed, 3),
+             "failed": bool(result.get("failed")), "changed": bool(result.get("changed")),
+             # nothing is left to change unless the setup has drifted it
+             "settled": scenario["state"] == "steady" and "setup" not in scenario,
+             "msg": result.get("msg") if result.get("failed") else None,
+             "commands": sum(commands.values()), "by_tool": commands,
+             "timings": result.get("timings", {}).get("by_tool", {}),
+             "spawns": sum(commands.values())+SpawnCounter.count,
+             "rpcs": sum(ldmxml.LDMXMLConnection.calls.values()),
+             "connections": ldmxml.LDMXMLConnection.connections }
+
+def check_thresholds(results, thresholds):
+    """ Return a list of counters that exceed their threshold. """
+    over = []
+    for result in results:
+        limits = thresholds.get(result["name"], {})
+        for counter in COUNTERS:
+            if counter in limits and result[counter] > limits[counter]:
+                over.append(result["name"]+" "+counter+": "+str(result[counter])+
+                            " > "+str(limits[counter]))
+    return over
+
+def report(results):
+    print "%-22s %8s %8s %8s %8s %6s  %s" % ("scenario", "seconds", "commands",
+                                            "spawns", "rpcs", "conns", "result")
+    for r in results:
+        status = "failed" if r["failed"] else ("changed" if r["changed"] else "ok")
+        if r["settled"] and r["changed"]:
+            status += " (expected ok)"
+        print "%-22s %8.3f %8d %8d %8d %6d  %s" % (r["name"], r["seconds"], r["commands"],
+                                                   r["spawns"], r["rpcs"], r["connections"],
+                                                   status)
+        if r["failed"]:
+            print "    "+str(r["msg"])
+
+def main():
+    parser = optparse.OptionParser(usage = "%prog [options]")
+    parser.add_option("--ldevs", type = "int", default = 256,
+                      help = "LDEVs on the simulated frame (default %default)")
+    parser.add_option("--rdsk", type = "int", default = 2000,
+                      help = "device nodes in the simulated /dev/rdsk (default %default)")
+    parser.add_option("--domains", type = "int", default = 20,
+                      help = "guest domains to build (default %default)")
+    parser.add_option("--env-ldevs", type = "int", default = 16,
+                      help = "LDEVs in the shared RAC storage group (default %default)")
+    parser.add_option("--grid-disks", type = "int", default = 16,
+                      help = "disks for grid_disk to label (default %default)")
+    parser.add_option("--latency", type = "float", default = 0.0,
+                      help = "seconds each fake command or ldmd call takes")
+    parser.add_option("--json", metavar = "FILE",
+                      help = "also write the results to FILE as JSON")
+    parser.add_option("--thresholds", metavar = "FILE", default = THRESHOLDS_FILE,
+                      help = "count limits to enforce (default %default)")
+    parser.add_option("--write-thresholds", action = "store_true", default = False,
+                      help = "record this run's counts as the new limits")
+    parser.add_option("--keep", action = "store_true", default = False,
+                      help = "keep the sandbox directory for inspection")
+    options, args = parser.parse_args()
+
+    scale = { "ldevs": options.ldevs, "rdsk": options.rdsk, "domains": options.domains,
+              "env_ldevs": options.env_ldevs, "grid_disks": options.grid_disks }
+    if scale["ldevs"] < 4*scale["domains"]+scale["env_ldevs"] or scale["rdsk"] <= scale["ldevs"]:
+        parser.error("need --ldevs >= 4*domains+env-ldevs and --rdsk > --ldevs")
+
+    install_shims()
+    sandbox = Sandbox(scale, options.latency)
+    SpawnCounter.install(sandbox.bin)
+    try:
+        results = [ run_scenario(sandbox, scenario) for scenario in scenarios(scale) ]
+    finally:
+        if options.keep:
+            print "sandbox kept in "+sandbox.root
+        else:
+            sandbox.remove()
+
+    report(results)
+    if options.json:
+        fh = open(options.json, "w")
+        json.dump({ "scale": scale, "latency": options.latency, "results": results },
+                  fh, indent = 2, sort_keys = True)
+        fh.close()
+
+    failed = [ r["name"] for r in results
+               if r["failed"] or (r["settled"] and r["changed"]) ]
+    if options.write_thresholds:
+        if failed:
+            print "not writing thresholds, failed: "+", ".join(failed)
+            sys.exit(1)
+        thresholds = { "scale": scale,
+                       "scenarios": dict((r["name"], dict((c, r[c]) for c in COUNTERS))
+                                         for r in results) }
+        fh = open(options.thresholds, "w")
+        json.dump(thresholds, fh, indent = 2, sort_keys = True)
+        fh.write("\n")
+        fh.close()
+        print "wrote "+options.thresholds
+        return
+
+    # counts only compare at the scale the thresholds were recorded at
+    over = []
+    if os.path.exists(options.thresholds):
+        fh = open(options.thresholds)
+        thresholds = json.load(fh)
+        fh.close()
+        if thresholds.get("scale") == scale:
+            over = check_thresholds(results, thresholds["scenarios"])
+        else:
+            print "scale differs from "+options.thresholds+", thresholds not checked"
+    for line in over:
+        print "OVER THRESHOLD: "+line
+    if failed or over:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
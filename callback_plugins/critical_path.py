@@ -0,0 +1,261 @@
+"""
+Record when every task finished on every host, and find the chain of task
+runs that decided how long the build took.
+
+Enable it in ansible.cfg:
+
+    callback_plugins   = ./callback_plugins/
+    callback_whitelist = critical_path
+
+Each task run is recorded as a (play, task, host) with its start and end
+time, status, tags and, for the autobuild modules, the per-tool C{timings}
+they return.  Working back from the last task run to finish, the critical
+path repeatedly steps to the run that finished last before the current one
+started; with the linear strategy that is the slowest host of the previous
+task, so the path names the host that held up each step.  Time between the
+two (forks, module transfer, the gap between playbook runs) is reported as
+wait.
+
+Runs of ansible-playbook that share a C{CRITICAL_PATH_BUILD} name are combined,
+so a build spread over storage.yml, chassis.yml and domain.yml is analysed as
+one:
+
+    export CRITICAL_PATH_BUILD=cluster7
+    ansible-playbook storage.yml && ansible-playbook chassis.yml && ansible-playbook domain.yml
+
+Environment:
+    - CRITICAL_PATH_BUILD: build name (default: one build per run)
+    - CRITICAL_PATH_DIR: where <build>.json and <build>.txt are written
+      (default ~/.ansible/critical_path)
+    - CRITICAL_PATH_TOP: critical path steps listed in the report (default 30)
+
+Task runs start when their task starts, as Ansible does not report when each
+host picked a task up; with fewer forks than hosts, queued hosts are charged
+for their wait in the queue.
+"""
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import os, json, time, tempfile, bisect
+
+from ansible.plugins.callback import CallbackBase
+
+DEFAULT_DIR = "~/.ansible/critical_path"
+DEFAULT_TOP = 30
+# end times within this many seconds of a start count as before it
+EPSILON = 0.001
+
+def module_timings(result):
+    """ Sum the per-tool C{timings} of a module result, and of each item of a
+    looped one. """
+    totals = dict()
+    results = [ result ]
+    if isinstance(result.get("results"), list):
+        results.extend(result["results"])
+    for item in results:
+        timings = item.get("timings") if isinstance(item, dict) else None
+        if not isinstance(timings, dict):
+            continue
+        for tool, tool_totals in (timings.get("by_tool") or {}).items():
+            total = totals.setdefault(tool, { "count": 0, "seconds": 0.0 })
+            total["count"] += tool_totals.get("count", 0)
+            total["seconds"] = round(total["seconds"]+tool_totals.get("seconds", 0), 3)
+    return totals
+
+def critical_path(task_runs):
+    """ Return the critical path through C{task_runs} as a list of them in
+    time order, each paired with the wait before it started. """
+    if len(task_runs) == 0:
+        return []
+    runs = sorted(task_runs, key = lambda r: (r["end"], r["end"]-r["start"]))
+    ends = [ r["end"] for r in runs ]
+    index = len(runs)-1
+    path = []
+    while True:
+        run = runs[index]
+        # the latest run to finish before this one started
+        pred = bisect.bisect_right(ends, run["start"]+EPSILON, 0, index)-1
+        if pred < 0:
+            path.append((run, 0.0))
+            break
+        path.append((run, round(max(run["start"]-runs[pred]["end"], 0), 3)))
+        index = pred
+    path.reverse()
+    return path
+
+def analyse(runs):
+    """ Build the profile for all runs of a build. """
+    task_runs = [ t for run in runs for t in run["tasks"] ]
+    path = critical_path(task_runs)
+    start = min(run["start"] for run in runs)
+    end = max(run["end"] for run in runs)
+
+    steps = []
+    by_tag = dict()
+    by_host = dict()
+    by_play = dict()
+    waited = 0.0
+    for run, wait in path:
+        seconds = round(run["end"]-run["start"], 3)
+        waited += wait
+        steps.append(dict(run, seconds = seconds, wait = wait))
+        for tag in run["tags"] or [ "untagged" ]:
+            by_tag[tag] = round(by_tag.get(tag, 0)+seconds, 3)
+        by_host[run["host"]] = round(by_host.get(run["host"], 0)+seconds, 3)
+        key = run["playbook"]+": "+run["play"]
+        by_play[key] = round(by_play.get(key, 0)+seconds, 3)
+
+    hosts = dict()
+    tools = dict()
+    for run in task_runs:
+        host = hosts.setdefault(run["host"], { "busy": 0.0, "last_end": run["end"] })
+        host["busy"] = round(host["busy"]+run["end"]-run["start"], 3)
+        host["last_end"] = max(host["last_end"], run["end"])
+        for tool, totals in run["timings"].items():
+            total = tools.setdefault(tool, { "count": 0, "seconds": 0.0 })
+            total["count"] += totals["count"]
+            total["seconds"] = round(total["seconds"]+totals["seconds"], 3)
+    for host in hosts.values():
+        # how much later this host could have finished without delaying the build
+        host["slack"] = round(end-host.pop("last_end"), 3)
+
+    return { "start": start, "end": end, "seconds": round(end-start, 3),
+             "runs": runs, "critical_path": steps, "waited": round(waited, 3),
+             "by_tag": by_tag, "by_host": by_host, "by_play": by_play,
+             "hosts": hosts, "tools": tools }
+
+def report(build, profile, top):
+    """ Render the profile as the text report. """
+    lines = []
+    lines.append("Build %s: %.1fs over %d run(s), %d task runs, %.1fs waiting between steps" %
+                 (build, profile["seconds"], len(profile["runs"]),
+                  sum(len(run["tasks"]) for run in profile["runs"]), profile["waited"]))
+    lines.append("")
+    lines.append("Critical path, slowest steps:")
+    steps = sorted(profile["critical_path"], key = lambda s: s["seconds"], reverse = True)[:top]
+    for step in sorted(steps, key = lambda s: s["start"]):
+        lines.append("  %9.1fs %7.1fs wait  %-24s %-14s %s / %s" %
+                     (step["seconds"], step["wait"], step["host"],
+                      ",".join(step["tags"]) or "-", step["play"], step["task"]))
+    for title, totals in (("Critical path by tag:", profile["by_tag"]),
+                          ("Critical path by host:", profile["by_host"]),
+                          ("Critical path by play:", profile["by_play"])):
+        lines.append("")
+        lines.append(title)
+        for name, seconds in sorted(totals.items(), key = lambda i: i[1], reverse = True):
+            lines.append("  %9.1fs  %s" % (seconds, name))
+    if profile["tools"]:
+        lines.append("")
+        lines.append("Module commands, all hosts:")
+        tools = sorted(profile["tools"].items(), key = lambda i: i[1]["seconds"], reverse = True)
+        for tool, totals in tools[:top]:
+            lines.append("  %9.1fs %6d x  %s" % (totals["seconds"], totals["count"], tool))
+    return lines
+
+def _load(path):
+    try:
+        with open(path) as f:
+            profile = json.load(f)
+    except (IOError, OSError, ValueError):
+        return dict()
+    if not isinstance(profile, dict):
+        return dict()
+    return profile
+
+def _save(path, text):
+    """ Write a file atomically so a concurrent run never reads a partial one. """
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, tmpname = tempfile.mkstemp(dir = directory, prefix = ".critical_path.")
+    with os.fdopen(fd, "w") as f:
+        f.write(text)
+    os.rename(tmpname, path)
+
+class CallbackModule(CallbackBase):
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = "aggregate"
+    CALLBACK_NAME = "critical_path"
+    CALLBACK_NEEDS_WHITELIST = True
+
+    def __init__(self, *args, **kwargs):
+        super(CallbackModule, self).__init__(*args, **kwargs)
+        now = time.time()
+        self.build = os.getenv("CRITICAL_PATH_BUILD") or time.strftime("%Y%m%d-%H%M%S", time.localtime(now))
+        self.directory = os.path.expanduser(os.getenv("CRITICAL_PATH_DIR", DEFAULT_DIR))
+        self.top = int(os.getenv("CRITICAL_PATH_TOP", DEFAULT_TOP))
+        self.run = { "start": now, "end": None, "playbooks": [], "tasks": [] }
+        self.playbook = None
+        self.play = None
+        self.play_tags = []
+        # start of every task currently running, by task uuid
+        self.task_starts = dict()
+
+    def v2_playbook_on_start(self, playbook):
+        self.playbook = os.path.basename(playbook._file_name)
+        self.run["playbooks"].append(self.playbook)
+
+    def v2_playbook_on_play_start(self, play):
+        self.play = play.get_name().strip()
+        self.play_tags = list(play.tags or [])
+
+    def v2_playbook_on_task_start(self, task, is_conditional):
+        self._start(task)
+
+    def v2_playbook_on_handler_task_start(self, task):
+        self._start(task)
+
+    def _start(self, task):
+        # with serial plays the same task starts again for every batch
+        info = { "task": task.get_name().strip(), "action": task.action,
+                 "tags": sorted(set(task.tags or []) | set(self.play_tags)),
+                 "start": time.time() }
+        self.task_starts[task._uuid] = info
+        return info
+
+    def _finish(self, result, status):
+        task = result._task
+        info = self.task_starts.get(task._uuid) or self._start(task)
+        self.run["tasks"].append({ "playbook": self.playbook, "play": self.play,
+                                   "task": info["task"], "action": info["action"],
+                                   "tags": info["tags"], "host": result._host.get_name(),
+                                   "start": info["start"], "end": time.time(),
+                                   "status": status,
+                                   "timings": module_timings(result._result) })
+
+    def v2_runner_on_ok(self, result):
+        self._finish(result, "changed" if result._result.get("changed") else "ok")
+
+    def v2_runner_on_failed(self, result, ignore_errors = False):
+        self._finish(result, "ignored" if ignore_errors else "failed")
+
+    def v2_runner_on_skipped(self, result):
+        self._finish(result, "skipped")
+
+    def v2_runner_on_unreachable(self, result):
+        self._finish(result, "unreachable")
+
+    def v2_playbook_on_stats(self, stats):
+        self.run["end"] = time.time()
+        json_file = os.path.join(self.directory, self.build+".json")
+        runs = []
+        if os.getenv("CRITICAL_PATH_BUILD"):
+            runs = [ run for run in _load(json_file).get("runs", [])
+                     if isinstance(run, dict) and run.get("end") is not None ]
+        runs.append(self.run)
+        if sum(len(run["tasks"]) for run in runs) == 0:
+            return
+        profile = analyse(runs)
+        lines = report(self.build, profile, self.top)
+
+        self._display.banner("CRITICAL PATH")
+        for line in lines:
+            self._display.display(line)
+        try:
+            _save(json_file, json.dumps(profile, indent = 1, sort_keys = True)+"\n")
+            _save(os.path.join(self.directory, self.build+".txt"), "\n".join(lines)+"\n")
+        except (IOError, OSError) as e:
+            self._display.warning("critical_path: unable to write profile to "+
+                                  self.directory+": "+str(e))
+        else:
+            self._display.display("Profile written to "+json_file)
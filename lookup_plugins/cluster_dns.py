@@ -0,0 +1,107 @@
+"""
+Resolve cluster host names on the controller in one parallel batch, backed by
+a TTL-bounded on-disk cache shared by every fork and play.
+
+    {{ lookup('cluster_dns', ldom_name) }}
+    {{ lookup('cluster_dns', cluster_priv_names, wantlist=True) }}
+    {{ lookup('cluster_dns', mgmt_hostname, prefetch=cluster_dns_names) }}
+
+Terms may be names or lists of names; one address is returned per name, in
+order.  Names given in C{prefetch} are resolved in the same batch and cached
+but not returned, so the first lookup of a run warms the cache for the rest.
+
+Keyword arguments:
+    - ttl: seconds a cached address stays valid (default 300)
+    - cache_file: cache location (default ~/.ansible/cluster_dns_cache.json)
+    - prefetch: extra names to resolve and cache
+"""
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import os, json, time, socket, tempfile
+from multiprocessing.pool import ThreadPool
+
+from ansible.errors import AnsibleError
+from ansible.plugins.lookup import LookupBase
+
+DEFAULT_TTL = 300
+DEFAULT_CACHE = "~/.ansible/cluster_dns_cache.json"
+MAX_THREADS = 32
+
+def _flatten(terms):
+    names = []
+    for term in terms:
+        if isinstance(term, (list, tuple)):
+            names.extend(_flatten(term))
+        elif term:
+            names.append(str(term))
+    return names
+
+def _resolve(name):
+    try:
+        return name, socket.gethostbyname(name), None
+    except socket.error as e:
+        return name, None, str(e)
+
+def _load(cache_file):
+    try:
+        with open(cache_file) as f:
+            cache = json.load(f)
+    except (IOError, OSError, ValueError):
+        return dict()
+    if not isinstance(cache, dict):
+        return dict()
+    return cache
+
+def _save(cache_file, cache):
+    """ Write the cache atomically so concurrent forks never see a partial file. """
+    directory = os.path.dirname(cache_file)
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, tmpname = tempfile.mkstemp(dir = directory, prefix = ".cluster_dns.")
+        with os.fdopen(fd, "w") as f:
+            json.dump(cache, f)
+        os.rename(tmpname, cache_file)
+    except (IOError, OSError):
+        # the cache only saves time; an unwritable one is not an error
+        pass
+
+class LookupModule(LookupBase):
+
+    def run(self, terms, variables = None, **kwargs):
+        ttl = int(kwargs.get("ttl", DEFAULT_TTL))
+        cache_file = os.path.expanduser(kwargs.get("cache_file", DEFAULT_CACHE))
+        names = _flatten(terms)
+        wanted = names+[ n for n in _flatten([kwargs.get("prefetch", [])]) if n not in names ]
+
+        now = time.time()
+        cache = _load(cache_file)
+        fresh = dict((name, entry[0]) for name, entry in cache.items()
+                     if isinstance(entry, list) and len(entry) == 2 and entry[1] > now)
+        missing = sorted(set(n for n in wanted if n not in fresh))
+
+        if missing:
+            pool = ThreadPool(min(len(missing), MAX_THREADS))
+            try:
+                results = pool.map(_resolve, missing)
+            finally:
+                pool.close()
+                pool.join()
+            errors = dict()
+            # merge with whatever other forks wrote while we were resolving
+            cache = _load(cache_file)
+            for name, addr, error in results:
+                if addr is None:
+                    errors[name] = error
+                    continue
+                fresh[name] = addr
+                cache[name] = [addr, now+ttl]
+            _save(cache_file, dict((n, e) for n, e in cache.items()
+                                   if isinstance(e, list) and len(e) == 2 and e[1] > now))
+            # prefetch misses are left for the lookup that actually needs them
+            failed = [ name+": "+errors[name] for name in names if name in errors ]
+            if failed:
+                raise AnsibleError("cluster_dns: unable to resolve "+", ".join(failed))
+
+        return [ fresh[name] for name in names ]
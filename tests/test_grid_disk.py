@@ -0,0 +1,49 @@
+""" Tests for the prtvtoc parsing in grid_disk, against a label printed by
+prtvtoc for an HDS LUN on a RAC domain. """
+import os, sys, unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(TESTS_DIR), "ansible_modules"))
+import grid_disk
+
+def fixture(name):
+    fh = open(os.path.join(TESTS_DIR, "fixtures", name))
+    try:
+        return fh.read()
+    finally:
+        fh.close()
+
+class ParseVtocTest(unittest.TestCase):
+
+    def setUp(self):
+        self.vtoc = grid_disk.parse_vtoc(fixture("prtvtoc_hds_lun.txt"))
+
+    def test_dimensions(self):
+        self.assertEqual(self.vtoc["dimensions"],
+                         { "bytes/sector": 512, "sectors/track": 640,
+                           "tracks/cylinder": 15, "sectors/cylinder": 9600,
+                           "cylinders": 2184, "accessible cylinders": 2182 })
+
+    def test_partitions(self):
+        self.assertEqual(self.vtoc["partitions"], [
+            { "slice": 0, "tag": "2", "flags": "00", "first": 0,
+              "count": 2097600, "last": 2097599 },
+            { "slice": 1, "tag": "3", "flags": "01", "first": 2097600,
+              "count": 2097600, "last": 4195199 },
+            { "slice": 2, "tag": "5", "flags": "01", "first": 0,
+              "count": 20947200, "last": 20947199 },
+            { "slice": 6, "tag": "4", "flags": "00", "first": 4195200,
+              "count": 16751360, "last": 20946559 } ])
+
+    def test_whole_disk_slice(self):
+        # slice 0 starts at the second cylinder and runs to the end of the
+        # accessible cylinders, which slice 2 covers from the first
+        self.assertEqual(grid_disk.whole_disk_slice(self.vtoc),
+                         "0 0 00 9600 20937600\n")
+
+    def test_whole_disk_slice_without_geometry(self):
+        self.assertRaises(ValueError, grid_disk.whole_disk_slice,
+                          { "dimensions": {}, "partitions": [] })
+
+if __name__ == "__main__":
+    unittest.main()